@@ -6,4 +6,20 @@ class ChatbotConfig(AppConfig):
 
     def ready(self):
         # We don't need to call register_chatbot_types anymore
-        pass
\ No newline at end of file
+        import atexit
+        from django.contrib.auth import get_user_model
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save
+        from .authentication import invalidate_cached_user
+        from .metrics import install_query_counter, registry
+        from .models import ChatbotSettingsSchema
+        from .schema_registry import invalidate_schema_registry
+
+        # Local writes drop the cache right away; other workers notice the new version stamp
+        post_save.connect(invalidate_schema_registry, sender=ChatbotSettingsSchema)
+        post_delete.connect(invalidate_schema_registry, sender=ChatbotSettingsSchema)
+        # Deactivations and password changes must not wait for the cached user to expire
+        post_save.connect(invalidate_cached_user, sender=get_user_model())
+        post_delete.connect(invalidate_cached_user, sender=get_user_model())
+        connection_created.connect(install_query_counter)
+        atexit.register(registry.flush, force=True)
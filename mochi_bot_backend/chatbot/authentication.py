@@ -0,0 +1,92 @@
+import copy
+import threading
+import time
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+class UserCache:
+    """
+    Process-wide cache of the users that access tokens resolve to, each kept for CHATBOT_AUTH['USER_CACHE_TTL']
+    seconds.
+
+    Saving or deleting a user drops its entry in this process right away; other workers see the change once
+    their entry expires, so a deactivated user or changed password takes effect everywhere within the TTL.
+    Changes that skip the model's signals, like QuerySet.update(), are only seen after the TTL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        # Bumped by every invalidation, so a user loaded before one is never cached after it
+        self._epoch = 0
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    def get(self, user_id):
+        entry = self._users.get(str(user_id))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        # Each request gets its own copy, so nothing a view sets on request.user leaks into the next request
+        return copy.copy(entry[1])
+
+    def set(self, user_id, user, epoch):
+        ttl = settings.CHATBOT_AUTH['USER_CACHE_TTL']
+        if ttl <= 0:
+            return
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            if len(self._users) >= settings.CHATBOT_AUTH['USER_CACHE_MAX_ENTRIES']:
+                self._users.pop(next(iter(self._users)))
+            self._users[str(user_id)] = (time.monotonic() + ttl, copy.copy(user))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._epoch += 1
+            self._users.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._users.clear()
+
+
+user_cache = UserCache()
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves the token's user from user_cache, sparing most requests the user query."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user = user_cache.get(user_id)
+        if user is None:
+            epoch = user_cache.epoch
+            try:
+                user = self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            user_cache.set(user_id, user, epoch)
+
+        # The same checks as JWTAuthentication, against the cached user
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return user
@@ -0,0 +1,218 @@
+import json
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, e.g. fraction=0.95 for p95."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class Recorder:
+    """Collects the latency and query count of every request, grouped by endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, queries, ok):
+        with self._lock:
+            self.samples[endpoint].append((seconds, queries))
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = [seconds * 1000 for seconds, _ in samples]
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors[endpoint],
+                'p50_ms': percentile(latencies, 0.50),
+                'p95_ms': percentile(latencies, 0.95),
+                'p99_ms': percentile(latencies, 0.99),
+                'mean_ms': sum(latencies) / len(latencies),
+                'queries_per_request': sum(queries for _, queries in samples) / len(samples),
+            }
+        total = sum(len(samples) for samples in self.samples.values())
+        return {'elapsed_s': elapsed, 'requests': total, 'requests_per_s': total / elapsed if elapsed else 0.0,
+                'endpoints': endpoints}
+
+
+class BenchmarkClient:
+    """A test client that authenticates with a real JWT, like the frontend, and times every call."""
+
+    def __init__(self, user, recorder):
+        self.client = Client(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        self.recorder = recorder
+
+    def call(self, endpoint, method, path, data=None):
+        body = json.dumps(data) if data is not None else None
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = getattr(self.client, method)(path, body, content_type='application/json')
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+        self.recorder.record(endpoint, elapsed, len(queries), response.status_code < 400)
+        if response.status_code >= 400:
+            return None
+        return None if response.streaming else response.json()
+
+
+class Scenario:
+    """
+    A scripted user session. setup() runs once and isn't measured; run() is one measured iteration.
+
+    Iterations may run concurrently, each on its own client.
+    """
+
+    def __init__(self, user, chatbot_type, turns):
+        self.user = user
+        self.chatbot_type = chatbot_type
+        self.turns = turns
+
+    def setup(self, client):
+        pass
+
+    def run(self, client, iteration):
+        raise NotImplementedError
+
+    def create_chatbot(self, client, endpoint='create_bot'):
+        return client.call(endpoint, 'post', '/api/chatbot/', {
+            'name': f'Bench {uuid.uuid4().hex[:8]}', 'desc': 'Benchmark bot', 'chatbot_type': self.chatbot_type,
+        })
+
+    def converse(self, client, chatbot_id, turns, stream=False):
+        thread = client.call('create_thread', 'post', '/api/thread/', {'chatbot': chatbot_id})
+        if thread is None:
+            return
+        endpoint, path = ('send_message_stream', '/api/chat/stream/') if stream else ('send_message', '/api/chat/')
+        for turn in range(turns):
+            client.call(endpoint, 'post', path, {
+                'chatbot_id': chatbot_id, 'thread_id': thread['id'], 'content': f'Question {turn}: how does this work?',
+            })
+
+
+class CreateBotScenario(Scenario):
+    def run(self, client, iteration):
+        self.create_chatbot(client)
+
+
+class CreateThreadsScenario(Scenario):
+    def setup(self, client):
+        self.chatbot = self.create_chatbot(client, 'setup')
+
+    def run(self, client, iteration):
+        client.call('create_thread', 'post', '/api/thread/', {'chatbot': self.chatbot['id']})
+
+
+class ConversationScenario(Scenario):
+    def setup(self, client):
+        self.chatbot = self.create_chatbot(client, 'setup')
+
+    def run(self, client, iteration):
+        self.converse(client, self.chatbot['id'], self.turns)
+
+
+class StreamingConversationScenario(ConversationScenario):
+    def run(self, client, iteration):
+        self.converse(client, self.chatbot['id'], self.turns, stream=True)
+
+
+class LogExportScenario(Scenario):
+    # Threads of conversation set up before the export is measured
+    THREADS = 20
+
+    def setup(self, client):
+        self.chatbot = self.create_chatbot(client, 'setup')
+        for _ in range(self.THREADS):
+            self.converse(client, self.chatbot['id'], self.turns)
+
+    def run(self, client, iteration):
+        chatbot_id = self.chatbot['id']
+        client.call('get_chat_logs', 'get', f'/api/chatbot/{chatbot_id}/logs/')
+        client.call('get_chat_logs_page', 'get', f'/api/chatbot/{chatbot_id}/logs/?limit=10')
+        client.call('export_chat_logs', 'get', f'/api/chatbot/{chatbot_id}/logs/export/')
+
+
+class SettingsChurnScenario(Scenario):
+    """Alternates settings updates with messages, so every reply comes from a freshly configured instance."""
+
+    def setup(self, client):
+        self.chatbot = self.create_chatbot(client, 'setup')
+        self.thread = client.call('setup', 'post', '/api/thread/', {'chatbot': self.chatbot['id']})
+        self.settings = client.call('setup', 'get', f"/api/chatbot/{self.chatbot['id']}/settings/")
+
+    def run(self, client, iteration):
+        chatbot_id = self.chatbot['id']
+        key, spec = next(iter(self.settings.items()))
+        value = iteration % 2 if spec.get('type') == 'number' else f'{spec.get("value", "")}{iteration % 2}'
+        client.call('chatbot_settings', 'get', f'/api/chatbot/{chatbot_id}/settings/')
+        client.call('chatbot_settings_put', 'put', f'/api/chatbot/{chatbot_id}/settings/', {key: value})
+        client.call('send_message', 'post', '/api/chat/', {
+            'chatbot_id': chatbot_id, 'thread_id': self.thread['id'], 'content': f'Settings round {iteration}',
+        })
+
+
+SCENARIOS = {
+    'create_bot': CreateBotScenario,
+    'create_threads': CreateThreadsScenario,
+    'conversation': ConversationScenario,
+    'conversation_stream': StreamingConversationScenario,
+    'log_export': LogExportScenario,
+    'settings_churn': SettingsChurnScenario,
+}
+
+
+def run_scenario(name, iterations=20, turns=5, chatbot_type='claudie', concurrency=1):
+    """Run one scenario against the current database and return its summary."""
+    user = User.objects.create_user(username=f'bench-{uuid.uuid4().hex[:12]}', password=uuid.uuid4().hex)
+    recorder = Recorder()
+    scenario = SCENARIOS[name](user, chatbot_type, turns)
+    scenario.setup(BenchmarkClient(user, Recorder()))
+
+    def iteration(number):
+        try:
+            scenario.run(BenchmarkClient(user, recorder), number)
+        finally:
+            if concurrency > 1:
+                close_old_connections()
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(iteration, range(iterations)))
+    else:
+        for number in range(iterations):
+            iteration(number)
+    return recorder.summary(time.perf_counter() - start)
+
+
+def format_report(results):
+    lines = []
+    header = f"{'endpoint':<22}{'reqs':>7}{'errs':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/req':>8}"
+    for name, summary in results.items():
+        lines.append(f"{name}: {summary['requests']} requests in {summary['elapsed_s']:.2f}s "
+                     f"({summary['requests_per_s']:.1f} req/s)")
+        lines.append(header)
+        for endpoint, stats in summary['endpoints'].items():
+            lines.append(
+                f"{endpoint:<22}{stats['requests']:>7}{stats['errors']:>6}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}"
+                f"{stats['p99_ms']:>9.1f}{stats['queries_per_request']:>8.1f}"
+            )
+        lines.append('')
+    return '\n'.join(lines)
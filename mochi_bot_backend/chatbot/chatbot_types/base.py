@@ -2,18 +2,39 @@ from abc import ABC, abstractmethod
 import anthropic
 import os
 import logging
-from typing import List, Dict, Any
+from asgiref.sync import sync_to_async
+from typing import List, Dict, Any, Iterator
+from chatbot.upstream import get_upstream
 
 class BaseChatbot(ABC):
     def __init__(self, chatbot_data):
         self.id = chatbot_data['id']
         self.name = chatbot_data['name']
+        self.chatbot_type = chatbot_data.get('chatbot_type')
+        self.settings_version = chatbot_data.get('settings_version')
         self.settings = self.convert_settings(chatbot_data['settings'], self.get_settings_schema())
 
     @abstractmethod
     def generate_response(self, message_content: str, thread_id: str) -> str:
         pass
 
+    async def agenerate_response(self, message_content: str, thread_id: str) -> str:
+        # Chatbots without a native async client run their sync implementation in a worker thread
+        return await sync_to_async(self.generate_response)(message_content, thread_id)
+
+    def stream_response(self, message_content: str, thread_id: str) -> Iterator[str]:
+        # Chatbots that can't stream yield their whole reply as a single chunk
+        yield self.generate_response(message_content, thread_id)
+
+    @property
+    def upstream(self):
+        # Shared by every instance of the type, so one failing upstream trips a single circuit breaker
+        return get_upstream(self.chatbot_type)
+
+    def is_deterministic(self) -> bool:
+        # Chatbots that always give the same reply to the same conversation can have replies served from the response cache
+        return False
+
     @abstractmethod
     def get_settings_schema(self) -> Dict[str, Any]:
         pass
@@ -1,42 +1,198 @@
 import anthropic
+import asyncio
+from asgiref.sync import sync_to_async
+import functools
 import os
 import logging
+import time
+from django.conf import settings
 from ..base import BaseChatbot
-from typing import List, Dict, Any
-from chatbot.models import Message  # Correct import for the Message model
+from typing import List, Dict, Any, Iterator
+from chatbot.context import ContextBuilder
+from chatbot.coalescing import make_key, singleflight
+from chatbot.response_cache import response_cache
+from chatbot.retrieval import retrieve
+from chatbot.metrics import record_llm_call
+from chatbot.upstream import generation_error, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Prompt caching was in beta with this SDK version; the header is harmless where it's generally available
+PROMPT_CACHING_BETA = 'prompt-caching-2024-07-31'
+
+
+def cached_block(text):
+    # A system or message block ending a prefix the API should cache
+    return {'type': 'text', 'text': text, 'cache_control': {'type': 'ephemeral'}}
+
+
+def cache_history_prefix(history):
+    """
+    Mark the history up to the newest user turn for caching. That prefix is exactly what the next turn
+    resends before its own new messages, so each turn reads the previous turn's cache entry and extends it.
+    """
+    if len(history) < 2:
+        return history
+    marked = list(history)
+    marked[-2] = {'role': history[-2]['role'], 'content': [cached_block(history[-2]['content'])]}
+    return marked
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(api_key):
+    # One client (and HTTP connection pool) per process, shared by every Claudie instance.
+    # Retries are left to the upstream client, which shares a circuit breaker across calls.
+    return anthropic.Anthropic(api_key=api_key, max_retries=0)
 
 class ClaudieChatbot(BaseChatbot):
     def __init__(self, chatbot_data):
         super().__init__(chatbot_data)
-        self.client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+        self.client = get_client(os.getenv('ANTHROPIC_API_KEY'))
+        self._async_client = None
+        self._async_client_loop = None
         self.character = self.settings.get('character', 'You are a helpful AI assistant.')
         self.temperature = self.settings.get('temperature', 1.0)
+        self.context_builder = ContextBuilder()
 
     def generate_response(self, message_content: str, thread_id: str) -> str:
-        # Fetch all messages related to the thread
-        messages = Message.objects.filter(thread_id=thread_id).order_by('created_at')
+        request = self.build_request(*self.context_builder.build(thread_id), retrieve(self.id, message_content))
 
-        # Build the conversation history
-        conversation_history = [{"role": msg.role, "content": msg.content} for msg in messages]
+        # Send request to the API, once for any identical requests arriving meanwhile
+        extra = self.cache_extra(request)
+        try:
+            return singleflight.do(
+                make_key(self, request['messages'], extra),
+                lambda: response_cache.get_or_generate(self, request['messages'], lambda: self.complete(request), extra=extra),
+            )
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            raise generation_error(e) from e
+
+    async def agenerate_response(self, message_content: str, thread_id: str) -> str:
+        summary, history = await self.context_builder.abuild(thread_id)
+        request = self.build_request(summary, history, await sync_to_async(retrieve)(self.id, message_content))
+
+        extra = self.cache_extra(request)
+        try:
+            return await singleflight.ado(
+                make_key(self, request['messages'], extra),
+                lambda: response_cache.aget_or_generate(self, request['messages'], lambda: self.acomplete(request), extra=extra),
+            )
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            raise generation_error(e) from e
 
-        # Debug print the conversation history
-        print(f"Debug: Conversation history before sending: {conversation_history}")
+    def complete(self, request: Dict[str, Any]) -> str:
+        start = time.perf_counter()
+        try:
+            response = self.upstream.call(lambda timeout: self.client.messages.create(**request, timeout=timeout))
+        except Exception:
+            record_llm_call(self.chatbot_type, time.perf_counter() - start, outcome='error')
+            raise
+        self.record_usage(response.usage, start)
+        return response.content[0].text
 
-        # Send request to the API
+    async def acomplete(self, request: Dict[str, Any]) -> str:
+        start = time.perf_counter()
         try:
-            response = self.client.messages.create(
-                system=self.character,
-                model="claude-3-5-sonnet-20240620",
-                messages=conversation_history,
-                max_tokens=1024,
-                temperature=self.temperature  # Using temperature setting as a number
+            response = await self.upstream.acall(
+                lambda timeout: self.async_client.messages.create(**request, timeout=timeout)
             )
-            assistant_message = response.content[0].text
+        except Exception:
+            record_llm_call(self.chatbot_type, time.perf_counter() - start, outcome='error')
+            raise
+        self.record_usage(response.usage, start)
+        return response.content[0].text
+
+    def record_usage(self, usage, start, output_tokens=None):
+        record_llm_call(
+            self.chatbot_type, time.perf_counter() - start, usage.input_tokens,
+            usage.output_tokens if output_tokens is None else output_tokens,
+            cache_read_tokens=getattr(usage, 'cache_read_input_tokens', None) or 0,
+            cache_write_tokens=getattr(usage, 'cache_creation_input_tokens', None) or 0,
+        )
+
+    def is_deterministic(self) -> bool:
+        return self.temperature == 0
+
+    def cache_extra(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        # Everything besides the messages that shapes the reply
+        return {key: value for key, value in request.items() if key != 'messages'}
+
+    @property
+    def async_client(self):
+        # Only built on the async path so sync requests don't pay for a second connection pool.
+        # Async connections belong to the event loop that opened them, so a new loop gets a new client.
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = anthropic.AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), max_retries=0)
+            self._async_client_loop = loop
+        return self._async_client
 
-            return assistant_message
+    def stream_response(self, message_content: str, thread_id: str) -> Iterator[str]:
+        request = self.build_request(*self.context_builder.build(thread_id), retrieve(self.id, message_content))
+
+        cache_key = None
+        if response_cache.is_enabled_for(self):
+            cache_key = response_cache.make_key(self, request['messages'], self.cache_extra(request))
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+
+        start = time.perf_counter()
+        stream = None
+        try:
+            chunks = []
+            # Only opening the stream is retried; once text has been sent to the client it can't be taken back
+            stream = self.upstream.call(
+                lambda timeout: self.client.messages.create(**request, stream=True, timeout=timeout), hedge=False
+            )
+            usage, output_tokens = None, 0
+            with stream:
+                for event in stream:
+                    if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                        chunks.append(event.delta.text)
+                        yield event.delta.text
+                    elif event.type == 'message_start':
+                        usage = event.message.usage
+                    elif event.type == 'message_delta':
+                        output_tokens = event.usage.output_tokens
+            if usage is not None:
+                self.record_usage(usage, start, output_tokens)
+            if cache_key:
+                response_cache.set(cache_key, ''.join(chunks))
         except Exception as e:
-            logging.error(f"Error generating response: {e}")
-            return "There was an error processing your request. Please try again."
+            if stream is not None and is_retryable(e):
+                # A stream that broke off after opening counts against the upstream too
+                self.upstream.breaker.record_failure()
+            record_llm_call(self.chatbot_type, time.perf_counter() - start, outcome='error')
+            logger.error("Error streaming response: %s", e)
+            raise generation_error(e) from e
+
+    def build_request(self, summary: str, conversation_history: List[Dict[str, str]],
+                      excerpts: List[str] = ()) -> Dict[str, Any]:
+        context = []
+        if summary:
+            context.append(f"Summary of the earlier conversation:\n{summary}")
+        if excerpts:
+            documents = '\n\n'.join(f"<excerpt>\n{excerpt}\n</excerpt>" for excerpt in excerpts)
+            context.append(f"Relevant excerpts from the uploaded documents:\n{documents}")
+
+        request = {
+            'system': '\n\n'.join([self.character] + context),
+            'model': "claude-3-5-sonnet-20240620",
+            'messages': conversation_history,
+            'max_tokens': 1024,
+            'temperature': self.temperature  # Using temperature setting as a number
+        }
+        if settings.CHATBOT_PROMPT_CACHING['ENABLED']:
+            # Cached prefixes are read back at a tenth of the input price. The persona rarely changes, the
+            # summary and excerpts change now and then, and each turn's history extends the previous one's.
+            request['system'] = [cached_block(self.character)] + ([cached_block('\n\n'.join(context))] if context else [])
+            request['messages'] = cache_history_prefix(conversation_history)
+            request['extra_headers'] = {'anthropic-beta': PROMPT_CACHING_BETA}
+        return request
 
     def get_settings_schema(self) -> Dict[str, Any]:
         return {
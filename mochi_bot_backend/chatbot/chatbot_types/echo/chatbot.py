@@ -1,9 +1,15 @@
 from ...chatbot_types.base import BaseChatbot
+from ...response_cache import response_cache
 
 class EchoChatbot(BaseChatbot):
     def generate_response(self, message_content: str, thread_id: str) -> str:
         prefix = self.settings.get('echo_prefix', 'Echo: ')
-        return f"{prefix}{message_content}"
+        return response_cache.get_or_generate(
+            self, [{"role": "user", "content": message_content}], lambda: f"{prefix}{message_content}"
+        )
+
+    def is_deterministic(self) -> bool:
+        return True
 
     def get_settings_schema(self):
         return {
@@ -0,0 +1,166 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from django.conf import settings
+from .metrics import registry
+from .response_cache import normalize_history
+
+# How often a worker sweeps old lock and result files out of the lock table directory
+PRUNE_INTERVAL = 60.0
+
+coalesced_requests = registry.counter(
+    'mochi_coalesced_generations_total',
+    'Generations by whether they called upstream (leader) or shared a concurrent identical call (follower)',
+    ['role'],
+)
+
+
+def make_key(chatbot, history, extra=None):
+    """Identical concurrent generations: same chatbot, same settings version, same conversation and request."""
+    payload = {
+        'chatbot_id': str(chatbot.id),
+        'settings_version': chatbot.settings_version,
+        'history': normalize_history(history),
+        'extra': extra,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Singleflight:
+    """
+    Lets concurrent identical generations share one upstream call.
+
+    The first caller for a key (the leader) runs generate(); callers arriving while it runs wait for it and
+    get its reply, or its exception. Callers after it finishes start afresh, so nothing is cached. Threads of
+    a worker share calls in memory and async callers share a task per event loop. With
+    CHATBOT_COALESCING['LOCK_DIR'] set, sync leaders also take a file lock per key there, so workers on the
+    same machine coalesce too: a worker finding the lock held waits for it and reads the reply the holder
+    left behind.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self._pruned_at = 0.0
+
+    @property
+    def enabled(self):
+        return settings.CHATBOT_COALESCING['ENABLED']
+
+    def do(self, key, generate):
+        if not self.enabled:
+            return generate()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            coalesced_requests.inc(role='follower')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._lead(key, generate)
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, agenerate):
+        if not self.enabled:
+            return await agenerate()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._tasks.get((loop, key))
+            leader = task is None
+            if leader:
+                # A task of its own keeps the call going for the others if the leading request is cancelled
+                task = self._tasks[(loop, key)] = loop.create_task(agenerate())
+                task.add_done_callback(lambda _: self._forget_task(loop, key))
+        coalesced_requests.inc(role='leader' if leader else 'follower')
+        return await asyncio.shield(task)
+
+    def _forget_task(self, loop, key):
+        with self._lock:
+            self._tasks.pop((loop, key), None)
+
+    def _lead(self, key, generate):
+        directory = settings.CHATBOT_COALESCING['LOCK_DIR']
+        if not directory:
+            coalesced_requests.inc(role='leader')
+            return generate()
+
+        os.makedirs(directory, exist_ok=True)
+        self._prune(directory)
+        path = os.path.join(directory, key)
+        with open(f'{path}.lock', 'a') as lock:
+            os.utime(lock.fileno())  # Marks the lock as in use, so pruning leaves it be
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is generating this reply; once it lets go its result is waiting for us
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                result = self._read_result(path)
+                if result is not None:
+                    coalesced_requests.inc(role='follower')
+                    return result
+            try:
+                coalesced_requests.inc(role='leader')
+                result = generate()
+                self._write_result(path, result)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_result(self, path):
+        # Only a result written moments ago answers the call we waited on; anything older is a past conversation's
+        try:
+            if time.time() - os.path.getmtime(f'{path}.result') > settings.CHATBOT_COALESCING['RESULT_TTL']:
+                return None
+            with open(f'{path}.result') as file:
+                return json.load(file)['result']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_result(self, path, result):
+        temporary = f'{path}.result.{os.getpid()}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump({'result': result}, file)
+        os.replace(temporary, f'{path}.result')
+
+    def _prune(self, directory):
+        now = time.monotonic()
+        if now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        # A lock removed just as another worker opens it only costs a duplicate upstream call
+        cutoff = time.time() - PRUNE_INTERVAL
+        for entry in os.scandir(directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+
+singleflight = Singleflight()
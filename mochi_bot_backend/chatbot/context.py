@@ -0,0 +1,104 @@
+from importlib import import_module
+from typing import Dict, List, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .models import Message, Thread
+from .turns import current_turn
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token, plus a little per-message overhead
+    return len(text) // 4 + 4
+
+
+def extractive_summary(previous_summary: str, messages: List[Dict[str, str]], max_chars: int) -> str:
+    """Fold messages into the running summary as one clipped line per turn, keeping the most recent lines."""
+    lines = previous_summary.splitlines() if previous_summary else []
+    for message in messages:
+        content = ' '.join(message['content'].split())
+        if len(content) > 200:
+            content = content[:197] + '...'
+        lines.append(f"{message['role']}: {content}")
+
+    while lines and sum(len(line) + 1 for line in lines) > max_chars:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+
+class ContextBuilder:
+    """
+    Builds the conversation context sent upstream for a thread.
+
+    Only the most recent messages that fit in MAX_MESSAGES and MAX_TOKENS are loaded. Turns that drop out
+    of that window are folded once into a rolling summary stored on Thread.metadata, so the per-turn cost
+    stays flat however long the thread gets.
+    """
+
+    def __init__(self, max_messages=None, max_tokens=None, summary_max_chars=None, summarizer=None):
+        config = settings.CHATBOT_CONTEXT
+        self.max_messages = max_messages or config['MAX_MESSAGES']
+        self.max_tokens = max_tokens or config['MAX_TOKENS']
+        self.summary_max_chars = summary_max_chars or config['SUMMARY_MAX_CHARS']
+        self.summarizer = summarizer or self._load_summarizer(config['SUMMARIZER'])
+
+    @staticmethod
+    def _load_summarizer(path):
+        module_name, function_name = path.rsplit('.', 1)
+        return getattr(import_module(module_name), function_name)
+
+    def build(self, thread_id: str) -> Tuple[str, List[Dict[str, str]]]:
+        """
+        Return the thread's rolling summary and the recent messages to send, oldest first. The user message
+        of the turn being generated (see Turn) ends the history even though it isn't saved yet.
+        """
+        turn = current_turn.get()
+        pending = turn.pending_for(thread_id) if turn is not None else None
+        limit = self.max_messages - (pending is not None)
+        thread = Thread.objects.only('metadata').get(id=thread_id)
+        summary = thread.metadata.get('summary', '')
+
+        # Messages the summary already covers are never resent, even when the window would have room for them
+        recent = Message.objects.filter(thread_id=thread_id)
+        summary_until = thread.metadata.get('summary_until')
+        if summary_until:
+            recent = recent.filter(created_at__gt=summary_until)
+        recent = list(recent.order_by('-created_at').only('role', 'content', 'created_at')[:limit])
+
+        window = [pending] if pending is not None else []
+        budget = self.max_tokens - (estimate_tokens(pending.content) if pending is not None else 0)
+        for message in recent:
+            budget -= estimate_tokens(message.content)
+            if budget < 0 and window:
+                break
+            window.append(message)
+        window.reverse()
+
+        # The upstream API expects the conversation to open with a user turn
+        while window and window[0].role != 'user':
+            window.pop(0)
+
+        if window and (len(window) - (pending is not None) < len(recent) or len(recent) == limit):
+            summary = self._fold(thread, summary, window[0].created_at)
+
+        return summary, [{"role": message.role, "content": message.content} for message in window]
+
+    async def abuild(self, thread_id: str) -> Tuple[str, List[Dict[str, str]]]:
+        return await sync_to_async(self.build)(thread_id)
+
+    def _fold(self, thread, summary, window_start):
+        # Everything older than the window that the summary hasn't absorbed yet, usually a turn or two
+        evicted = Message.objects.filter(thread_id=thread.id, created_at__lt=window_start)
+        summary_until = thread.metadata.get('summary_until')
+        if summary_until:
+            evicted = evicted.filter(created_at__gt=summary_until)
+        evicted = list(evicted.order_by('created_at').only('role', 'content', 'created_at'))
+        if not evicted:
+            return summary
+
+        summary = self.summarizer(
+            summary, [{"role": message.role, "content": message.content} for message in evicted], self.summary_max_chars
+        )
+        thread.metadata['summary'] = summary
+        thread.metadata['summary_until'] = evicted[-1].created_at.isoformat()
+        Thread.objects.filter(id=thread.id).update(metadata=thread.metadata)
+        return summary
@@ -0,0 +1,137 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .file_handler import adopt_staged_file, delete_file, release_blob
+from .jobs import get_executor, run_in_background
+from .models import Document
+from .retrieval import VectorIndex, get_embedder, index_document, remove_document
+
+logger = logging.getLogger(__name__)
+
+
+def submit_document_task(fn, *args):
+    """
+    Run fn(*args) once the current transaction commits, off the request thread.
+
+    CHATBOT_DOCUMENTS['BACKEND'] is 'thread' for the bounded in-process pool or 'immediate' to run inline (tests).
+    """
+    if settings.CHATBOT_DOCUMENTS['BACKEND'] == 'immediate':
+        transaction.on_commit(lambda: fn(*args))
+        return
+    executor = get_executor('documents', settings.CHATBOT_DOCUMENTS['WORKERS'])
+    transaction.on_commit(lambda: executor.submit(run_in_background, fn, *args))
+
+
+def enqueue_document(chatbot, name, staged_path, size):
+    document = Document.objects.create(chatbot=chatbot, name=name, path=staged_path, size=size)
+    submit_document_task(process_document, document.id)
+    return document
+
+
+def _claimable():
+    # A document processing for longer than STALL_TIMEOUT without progress lost its worker, e.g. to a restart
+    stalled_before = timezone.now() - timedelta(seconds=settings.CHATBOT_DOCUMENTS['STALL_TIMEOUT'])
+    return Q(status=Document.STATUS_QUEUED) | Q(status=Document.STATUS_PROCESSING, updated_at__lt=stalled_before)
+
+
+def claim_document(document_id):
+    """
+    Move a queued or stalled document to processing; returns False if another worker got to it first or it was
+    deleted.
+    """
+    return Document.objects.filter(_claimable(), id=document_id).update(
+        status=Document.STATUS_PROCESSING, updated_at=timezone.now()
+    ) == 1
+
+
+def process_document(document_id):
+    """
+    Move a staged upload into the blob store and index its text.
+
+    The document may be deleted at any point while this runs. Each step is recorded with a conditional
+    update, and whatever was already done for a document that no longer exists is undone here.
+    """
+    if not claim_document(document_id):
+        return
+
+    document = Document.objects.filter(id=document_id).first()
+    if document is None:
+        return
+    try:
+        sha256, path = document.sha256, document.path
+        # A stalled document reclaimed after its upload moved into the blob store only needs indexing
+        if not sha256:
+            blob = adopt_staged_file(document.path)
+            if not Document.objects.filter(id=document_id).update(
+                path=blob.path, sha256=blob.sha256, size=blob.size, updated_at=timezone.now()
+            ):
+                release_blob(blob.sha256)
+                return
+            sha256, path = blob.sha256, blob.path
+
+        # Indexing a document twice adds nothing the second time
+        index_document(document.chatbot_id, sha256, path)
+        meta = VectorIndex(document.chatbot_id).read_meta() or {'sources': {}}
+        if not Document.objects.filter(id=document_id).update(
+            status=Document.STATUS_READY, chunk_count=meta['sources'].get(sha256, 0), updated_at=timezone.now()
+        ):
+            forget_document_text(document.chatbot_id, sha256)
+    except Exception as e:
+        logger.exception("Processing document %s failed", document_id)
+        Document.objects.filter(id=document_id).update(
+            status=Document.STATUS_FAILED, error=str(e), updated_at=timezone.now()
+        )
+
+
+def forget_document_text(chatbot_id, sha256):
+    # Identical files uploaded to the same chatbot share their index rows
+    if not Document.objects.filter(chatbot_id=chatbot_id, sha256=sha256).exists():
+        remove_document(chatbot_id, sha256)
+
+
+def discard_document(chatbot_id, sha256, path):
+    """Clean up after a deleted document: its index rows, its blob reference, or its staged upload."""
+    if not sha256:
+        # Not processed yet. If processing is under way it notices the document is gone and cleans up itself.
+        delete_file(path)
+        return
+    forget_document_text(chatbot_id, sha256)
+    release_blob(sha256)
+
+
+def process_queued_documents():
+    """
+    Process documents left queued, e.g. by a restart before the pool got to them, or stalled in processing.
+    Returns how many were run.
+    """
+    document_ids = list(
+        Document.objects.filter(_claimable()).order_by('created_at').values_list('id', flat=True)
+    )
+    for document_id in document_ids:
+        process_document(document_id)
+    return len(document_ids)
+
+
+def reindex_documents():
+    """
+    Rebuild the indexes made with other dimensions than the embedder's, e.g. after CHATBOT_RETRIEVAL['DIMENSIONS']
+    changed, from the ready documents' blobs. Returns how many chatbots were reindexed.
+    """
+    dimensions = get_embedder().dimensions
+    chatbot_ids = Document.objects.filter(status=Document.STATUS_READY).values_list('chatbot_id', flat=True).distinct()
+    reindexed = 0
+    for chatbot_id in chatbot_ids:
+        index = VectorIndex(chatbot_id)
+        meta = index.read_meta()
+        if meta is not None and meta['dimensions'] == dimensions:
+            continue
+        index.drop()
+        for sha256, path in Document.objects.filter(chatbot_id=chatbot_id, status=Document.STATUS_READY).values_list(
+            'sha256', 'path'
+        ).distinct():
+            index_document(chatbot_id, sha256, path)
+        reindexed += 1
+    return reindexed
@@ -1,7 +1,15 @@
+import threading
+from collections import OrderedDict
 from django.conf import settings
 from importlib import import_module
 
 class ChatbotFactory:
+    # Resolved classes, keyed by dotted class path
+    _class_cache = {}
+    # Warm chatbot instances, keyed by (chatbot id, chatbot type, settings version), least recently used first
+    _instance_pool = OrderedDict()
+    _instance_pool_lock = threading.Lock()
+
     @classmethod
     def register_chatbot_types(cls):
         # This method is now a no-op since we're using settings.CHATBOT_TYPES
@@ -13,9 +21,40 @@ class ChatbotFactory:
             raise ValueError(f"Unknown chatbot type: {chatbot_type}")
         
         class_path = settings.CHATBOT_TYPES[chatbot_type]['class']
-        module_name, class_name = class_path.rsplit('.', 1)
-        module = import_module(module_name)
-        return getattr(module, class_name)
+        chatbot_class = cls._class_cache.get(class_path)
+        if chatbot_class is None:
+            module_name, class_name = class_path.rsplit('.', 1)
+            module = import_module(module_name)
+            chatbot_class = cls._class_cache[class_path] = getattr(module, class_name)
+        return chatbot_class
+
+    @classmethod
+    def get_chatbot_instance(cls, chatbot):
+        """
+        Return a chatbot instance for the given Chatbot model, reusing a pooled one when its settings haven't changed.
+
+        Instances hold their API clients, so reusing them keeps HTTP connections and TLS sessions warm across messages.
+        """
+        key = (str(chatbot.id), chatbot.chatbot_type, chatbot.settings.version)
+        with cls._instance_pool_lock:
+            instance = cls._instance_pool.get(key)
+            if instance is not None:
+                cls._instance_pool.move_to_end(key)
+                return instance
+
+        instance = cls.get_chatbot_class(chatbot.chatbot_type)(chatbot.to_dict())
+
+        with cls._instance_pool_lock:
+            cls._instance_pool[key] = instance
+            cls._instance_pool.move_to_end(key)
+            while len(cls._instance_pool) > settings.CHATBOT_INSTANCE_POOL_SIZE:
+                cls._instance_pool.popitem(last=False)
+        return instance
+
+    @classmethod
+    def clear_instance_pool(cls):
+        with cls._instance_pool_lock:
+            cls._instance_pool.clear()
 
     @classmethod
     def create_chatbot(cls, chatbot_data):
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeMessagesHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/messages like the Anthropic Messages API, streaming or not, after the server's delays."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/v1/messages':
+            return self.send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}})
+
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        number = server.count_request()
+        time.sleep(server.latency)
+        if number <= server.failures or (server.error_rate and random.random() < server.error_rate):
+            return self.send_json(529, {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'Overloaded'}})
+
+        words = server.reply_words(request)
+        usage = dict(server.count_input_tokens(request), output_tokens=len(words))
+        message = {
+            'id': f'msg_{uuid.uuid4().hex}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': request.get('model', 'fake-model'),
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+        }
+        if request.get('stream'):
+            self.stream(message, words, usage)
+        else:
+            self.send_json(200, dict(message, content=[{'type': 'text', 'text': ' '.join(words)}], usage=usage))
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event(self, event, data):
+        payload = f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+        self.wfile.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+        self.wfile.flush()
+
+    def stream(self, message, words, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        start = dict(message, content=[], stop_reason=None, usage=dict(usage, output_tokens=0))
+        self.send_event('message_start', {'type': 'message_start', 'message': start})
+        self.send_event('content_block_start', {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+        for position, word in enumerate(words):
+            time.sleep(self.server.token_delay)
+            text = word if position == 0 else f' {word}'
+            self.send_event('content_block_delta', {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}})
+        self.send_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        self.send_event('message_delta', {
+            'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+            'usage': {'output_tokens': usage['output_tokens']},
+        })
+        self.send_event('message_stop', {'type': 'message_stop'})
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Anthropic Messages API, for benchmarks and tests.
+
+    Every reply waits `latency` seconds, then produces `reply_tokens` words (one per `token_delay` seconds when
+    streaming). The first `failures` requests, and a fraction `error_rate` of the rest, fail with 529 Overloaded.
+    Point the SDK at it through ANTHROPIC_BASE_URL.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, token_delay=0.0, reply_tokens=30, error_rate=0.0,
+                 failures=0):
+        super().__init__((host, port), FakeMessagesHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.failures = failures
+        self.requests = 0
+        self.prompt_cache = set()
+        self._requests_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count_request(self):
+        with self._requests_lock:
+            self.requests += 1
+            return self.requests
+
+    def reply_words(self, request):
+        last = request.get('messages', [{}])[-1].get('content', '')
+        if isinstance(last, list):
+            last = ' '.join(block.get('text', '') for block in last)
+        words = (last.split() or ['ok']) * (self.reply_tokens // max(len(last.split()), 1) + 1)
+        return ['Reply:'] + words[:max(self.reply_tokens - 1, 0)]
+
+    def count_input_tokens(self, request):
+        """
+        Input usage split like the API's: of the prompt up to its last cache breakpoint, the longest prefix (ending
+        at any block) that an earlier request cached at one of its breakpoints is read, and the rest is written.
+        """
+        system = request.get('system', '')
+        blocks = [{'type': 'text', 'text': system}] if isinstance(system, str) else list(system)
+        for message in request.get('messages', []):
+            content = message.get('content', '')
+            blocks.extend([{'type': 'text', 'text': content}] if isinstance(content, str) else content)
+
+        texts = [json.dumps(block.get('text', ''), ensure_ascii=False) for block in blocks]
+        breakpoints = [index + 1 for index, block in enumerate(blocks) if block.get('cache_control')]
+        cached = breakpoints[-1] if breakpoints else 0
+        read = 0
+        with self._requests_lock:
+            for end in range(cached, 0, -1):
+                if hashlib.sha256('\0'.join(texts[:end]).encode()).hexdigest() in self.prompt_cache:
+                    read = end
+                    break
+            self.prompt_cache.update(hashlib.sha256('\0'.join(texts[:end]).encode()).hexdigest() for end in breakpoints)
+        return {
+            'input_tokens': len(''.join(texts[cached:])) // 4,
+            'cache_creation_input_tokens': len(''.join(texts[read:cached])) // 4,
+            'cache_read_input_tokens': len(''.join(texts[:read])) // 4,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-llm', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
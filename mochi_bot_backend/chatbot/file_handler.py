@@ -1,20 +1,89 @@
+import hashlib
 import os
+import uuid
 from werkzeug.utils import secure_filename
 from django.conf import settings
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import Blob
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx'}
 
+# Uploads are read in pieces of this size, so a file is never held in memory whole
+CHUNK_SIZE = 64 * 1024
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def hash_file(file):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in file.chunks(CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+def blob_path(sha256, filename):
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    return f'blobs/{sha256[:2]}/{sha256}{extension}'
+
 def save_uploaded_file(file):
-    if file and allowed_file(file.name):
-        filename = secure_filename(file.name)
-        path = default_storage.save(f'uploads/{filename}', ContentFile(file.read()))
-        return path
-    return None
+    """
+    Store an upload in the content-addressed blob store and return its Blob, or None if the file type isn't allowed.
+
+    Identical contents are stored once: a re-upload only adds a reference to the existing blob.
+    """
+    if not (file and allowed_file(file.name)):
+        return None
+    return store_blob(file)
+
+def store_blob(file):
+    sha256, size = hash_file(file)
+    if Blob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + 1):
+        return Blob.objects.get(sha256=sha256)
+
+    # Storage backends read the file through chunks(), so the bytes are streamed to storage
+    path = default_storage.save(blob_path(sha256, file.name), file)
+    try:
+        with transaction.atomic():
+            return Blob.objects.create(sha256=sha256, path=path, size=size, ref_count=1)
+    except IntegrityError:
+        # A concurrent upload of the same contents won the race; keep its copy
+        default_storage.delete(path)
+        Blob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + 1)
+        return Blob.objects.get(sha256=sha256)
+
+def stage_upload(file):
+    """
+    Park an upload under incoming/ for background processing and return its path, or None if the type isn't allowed.
+
+    Large uploads already sit in a temporary file, which the filesystem storage moves into place rather than copies.
+    """
+    if not (file and allowed_file(file.name)):
+        return None
+    extension = os.path.splitext(secure_filename(file.name))[1].lower()
+    return default_storage.save(f'incoming/{uuid.uuid4().hex}{extension}', file)
+
+def adopt_staged_file(path):
+    """Move a staged upload into the blob store and return its Blob."""
+    with default_storage.open(path, 'rb') as file:
+        blob = store_blob(file)
+    delete_file(path)
+    return blob
+
+def release_blob(sha256):
+    """Drop one reference to a blob, deleting its bytes once nothing refers to it. Returns False if it doesn't exist."""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None:
+            return False
+        if blob.ref_count > 1:
+            Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+            return True
+        blob.delete()
+        transaction.on_commit(lambda: delete_file(blob.path))
+    return True
 
 def delete_file(file_path):
     if default_storage.exists(file_path):
@@ -23,4 +92,4 @@ def delete_file(file_path):
     return False
 
 def get_file_url(file_path):
-    return default_storage.url(file_path)
\ No newline at end of file
+    return default_storage.url(file_path)
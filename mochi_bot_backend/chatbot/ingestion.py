@@ -0,0 +1,98 @@
+import codecs
+import logging
+import os
+import re
+import zipfile
+from typing import Iterable, Iterator
+from xml.etree.ElementTree import iterparse
+from django.conf import settings
+from django.core.files.storage import default_storage
+from .file_handler import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+def extract_txt(file) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        data = file.read(CHUNK_SIZE)
+        if not data:
+            break
+        yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+
+def extract_docx(file) -> Iterator[str]:
+    # document.xml is parsed incrementally, so large documents never build a full element tree
+    with zipfile.ZipFile(file) as archive, archive.open('word/document.xml') as document:
+        for event, element in iterparse(document, events=('end',)):
+            if element.tag == f'{WORD_NAMESPACE}t' and element.text:
+                yield element.text
+            elif element.tag == f'{WORD_NAMESPACE}tab':
+                yield '\t'
+            elif element.tag == f'{WORD_NAMESPACE}p':
+                yield '\n'
+                element.clear()
+
+
+def extract_pdf(file) -> Iterator[str]:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        logger.warning("pypdf is not installed, skipping PDF text extraction")
+        return
+    for page in PdfReader(file).pages:
+        yield (page.extract_text() or '') + '\n'
+
+
+EXTRACTORS = {
+    'txt': extract_txt,
+    'docx': extract_docx,
+    'pdf': extract_pdf,
+}
+
+
+def extract_text(path: str) -> Iterator[str]:
+    """Yield the text of a stored document piece by piece. Unsupported types yield nothing."""
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    extractor = EXTRACTORS.get(extension)
+    if extractor is None:
+        return
+    with default_storage.open(path, 'rb') as file:
+        yield from extractor(file)
+
+
+def chunk_text(pieces: Iterable[str], chunk_chars: int = None, overlap: int = None) -> Iterator[str]:
+    """
+    Split streamed text into chunks of about chunk_chars characters, breaking on whitespace.
+
+    Consecutive chunks share roughly `overlap` characters so a passage cut at a boundary is still
+    retrievable from one of them. Only one chunk's worth of text is buffered at a time.
+    """
+    config = settings.CHATBOT_RETRIEVAL
+    chunk_chars = chunk_chars or config['CHUNK_CHARS']
+    overlap = config['CHUNK_OVERLAP'] if overlap is None else overlap
+
+    buffer = ''
+    carried = 0  # Length of the overlap at the start of the buffer, already part of the previous chunk
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_chars:
+            cut = buffer.rfind(' ', 0, chunk_chars)
+            if cut <= overlap:
+                cut = chunk_chars
+            chunk = ' '.join(buffer[:cut].split())
+            if chunk:
+                yield chunk
+            start = buffer.find(' ', cut - overlap, cut) if overlap else -1
+            buffer = buffer[start + 1:] if start >= 0 else buffer[cut:]
+            carried = cut - start - 1 if start >= 0 else 0
+    chunk = ' '.join(buffer.split())
+    if chunk and len(buffer) > carried:
+        yield chunk
+
+
+def iter_chunks(path: str) -> Iterator[str]:
+    return chunk_text(re.sub(r'\s+', ' ', piece) for piece in extract_text(path))
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .metrics import collect_usage
+from .models import GenerationJob, Message
+from .rate_limits import Admission, rate_limiter
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    """Return the process-wide thread pool called name, creating it on first use."""
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'mochi-{name}')
+        return executor
+
+
+def run_in_background(fn, *args):
+    # Runs on a pool thread, which gets its own DB connection that has to be cleaned up like a request's
+    close_old_connections()
+    try:
+        fn(*args)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(fn, '__name__', fn))
+    finally:
+        close_old_connections()
+
+
+def claim_job(job_id):
+    """Move a queued job to running; returns False if another worker got to it first."""
+    return GenerationJob.objects.filter(id=job_id, status=GenerationJob.STATUS_QUEUED).update(
+        status=GenerationJob.STATUS_RUNNING, updated_at=timezone.now()
+    ) == 1
+
+
+def run_generation_job(job_id):
+    if not claim_job(job_id):
+        return
+
+    job = GenerationJob.objects.select_related('chatbot', 'user_message').get(id=job_id)
+    usage = None
+    try:
+        with collect_usage() as usage:
+            response = job.chatbot.generate_response(job.user_message.content, str(job.thread_id))
+        with transaction.atomic():
+            job.assistant_message = Message.objects.create(
+                thread_id=job.thread_id, role='assistant', content=response, metadata=usage.as_metadata()
+            )
+            job.status = GenerationJob.STATUS_DONE
+            job.save(update_fields=['assistant_message', 'status', 'updated_at'])
+    except Exception as e:
+        logger.exception("Generation job %s failed", job_id)
+        job.status = GenerationJob.STATUS_FAILED
+        job.error = str(e)
+        job.save(update_fields=['status', 'error', 'updated_at'])
+    finally:
+        if job.rate_limit:
+            # The enqueuing request's slots are held until the reply is done, and charged what it cost
+            used = usage.input_tokens + usage.output_tokens if usage else 0
+            Admission.resume(rate_limiter, job.rate_limit).release(used_tokens=used)
+
+
+class ThreadPoolJobBackend:
+    """Runs jobs on a bounded in-process thread pool. Jobs still queued when the process stops stay queued."""
+
+    def enqueue(self, job):
+        executor = get_executor('generation', settings.CHATBOT_JOBS['WORKERS'])
+        transaction.on_commit(lambda: executor.submit(run_in_background, run_generation_job, job.id))
+
+
+class DatabaseJobBackend:
+    """Leaves jobs in the database for `manage.py run_generation_worker` processes to pick up."""
+
+    def enqueue(self, job):
+        pass
+
+
+class ImmediateJobBackend:
+    """Runs jobs inline once the enqueuing transaction commits. Meant for tests and local debugging."""
+
+    def enqueue(self, job):
+        transaction.on_commit(lambda: run_generation_job(job.id))
+
+
+JOB_BACKENDS = {
+    'thread': ThreadPoolJobBackend,
+    'db': DatabaseJobBackend,
+    'immediate': ImmediateJobBackend,
+}
+
+
+def enqueue_generation(chatbot, thread, user_message, admission=None):
+    """Queue a reply to user_message; the job takes over the request's rate limit admission, if given."""
+    rate_limit = admission.hand_off() if admission is not None else {}
+    job = GenerationJob.objects.create(chatbot=chatbot, thread=thread, user_message=user_message, rate_limit=rate_limit)
+    JOB_BACKENDS[settings.CHATBOT_JOBS['BACKEND']]().enqueue(job)
+    return job
+
+
+def requeue_stalled_jobs():
+    """
+    Put jobs back in the queue that have been running for longer than CHATBOT_UPSTREAM['DEADLINE'], the most
+    a generation can spend waiting on the model: their worker died before it could finish them.
+    """
+    stalled_before = timezone.now() - timedelta(seconds=settings.CHATBOT_UPSTREAM['DEADLINE'])
+    requeued = GenerationJob.objects.filter(status=GenerationJob.STATUS_RUNNING, updated_at__lt=stalled_before).update(
+        status=GenerationJob.STATUS_QUEUED, updated_at=timezone.now()
+    )
+    if requeued:
+        logger.warning("Re-queued %d stalled generation jobs", requeued)
+    return requeued
+
+
+def run_worker(poll_interval=None, once=False):
+    """Process queued jobs from the database, oldest first. Several workers can run side by side."""
+    poll_interval = poll_interval or settings.CHATBOT_JOBS['POLL_INTERVAL']
+    while True:
+        requeue_stalled_jobs()
+        job_ids = list(
+            GenerationJob.objects.filter(status=GenerationJob.STATUS_QUEUED)
+            .order_by('created_at')
+            .values_list('id', flat=True)[:10]
+        )
+        for job_id in job_ids:
+            run_generation_job(job_id)
+        if once:
+            return
+        if not job_ids:
+            close_old_connections()
+            time.sleep(poll_interval)
+
+
+async def await_job(job_id, timeout):
+    """Long-poll: return the job as soon as it finishes, or as it stands after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await GenerationJob.objects.select_related('user_message', 'assistant_message').aget(id=job_id)
+        if job.status in (GenerationJob.STATUS_DONE, GenerationJob.STATUS_FAILED) or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(min(0.25, max(deadline - time.monotonic(), 0)))
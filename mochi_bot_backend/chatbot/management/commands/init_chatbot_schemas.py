@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from chatbot.models import ChatbotSettingsSchema
+from chatbot.schema_registry import schema_registry
 from django.conf import settings
 
 class Command(BaseCommand):
@@ -33,4 +34,6 @@ class Command(BaseCommand):
 
             self.stdout.write(self.style.SUCCESS(f'Successfully initialized/updated schema for {chatbot_type}'))
 
+        # Saving bumps each row's updated_at, which running workers pick up as a new schema version
+        schema_registry.invalidate()
         self.stdout.write(self.style.SUCCESS('All chatbot settings schemas have been initialized/updated.'))
\ No newline at end of file
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from chatbot.documents import process_queued_documents, reindex_documents
+
+class Command(BaseCommand):
+    help = 'Process uploaded documents still queued or stalled, e.g. after a restart interrupted the background pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reindex', action='store_true', help='Also rebuild indexes made with other embedding dimensions'
+        )
+
+    def handle(self, *args, **options):
+        if options['reindex']:
+            count = reindex_documents()
+            self.stdout.write(self.style.SUCCESS(f'Reindexed the documents of {count} chatbots'))
+        count = process_queued_documents()
+        self.stdout.write(self.style.SUCCESS(f'Processed {count} queued or stalled documents'))
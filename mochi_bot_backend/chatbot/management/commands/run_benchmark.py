@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+from unittest import mock
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from chatbot.benchmark import SCENARIOS, format_report, run_scenario
+from chatbot.chatbot_types.claudie.chatbot import get_client
+from chatbot.factory import ChatbotFactory
+from chatbot.fake_llm import FakeLLMServer
+
+class Command(BaseCommand):
+    help = 'Benchmark the chat API against a throwaway database and a local fake Anthropic server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', choices=[[]] + list(SCENARIOS), help='Scenarios to run (default: all)')
+        parser.add_argument('--iterations', type=int, default=20, help='Measured iterations per scenario')
+        parser.add_argument('--turns', type=int, default=5, help='Messages per conversation')
+        parser.add_argument('--concurrency', type=int, default=1, help='Iterations run in parallel')
+        parser.add_argument('--chatbot-type', default='claudie', help='Chatbot type the scenarios talk to')
+        parser.add_argument('--llm-latency', type=float, default=0.05, help='Seconds before the fake LLM answers')
+        parser.add_argument('--llm-token-delay', type=float, default=0.0, help='Seconds between streamed tokens')
+        parser.add_argument('--llm-reply-tokens', type=int, default=30, help='Words in each fake reply')
+        parser.add_argument('--llm-error-rate', type=float, default=0.0, help='Fraction of upstream calls that fail')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Apply CHATBOT_RATE_LIMITS (off by default, so they do not cap the load)')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        server = FakeLLMServer(
+            latency=options['llm_latency'], token_delay=options['llm_token_delay'],
+            reply_tokens=options['llm_reply_tokens'], error_rate=options['llm_error_rate'],
+        ).start()
+        environment = {'ANTHROPIC_BASE_URL': server.url, 'ANTHROPIC_API_KEY': 'benchmark'}
+
+        # SQLite's in-memory test database can't be shared by concurrent threads, so use a file
+        scratch = tempfile.TemporaryDirectory()
+        if connection.vendor == 'sqlite':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(scratch.name, 'benchmark.sqlite3')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            rate_limits = {**settings.CHATBOT_RATE_LIMITS, 'ENABLED': options['rate_limits']}
+            with mock.patch.dict(os.environ, environment), override_settings(CHATBOT_RATE_LIMITS=rate_limits):
+                get_client.cache_clear()
+                ChatbotFactory.clear_instance_pool()
+                call_command('init_chatbot_schemas', stdout=open(os.devnull, 'w'))
+                results = {
+                    name: run_scenario(
+                        name, iterations=options['iterations'], turns=options['turns'],
+                        chatbot_type=options['chatbot_type'], concurrency=options['concurrency'],
+                    )
+                    for name in options['scenarios'] or SCENARIOS
+                }
+        finally:
+            get_client.cache_clear()
+            ChatbotFactory.clear_instance_pool()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            server.stop()
+            scratch.cleanup()
+
+        results_summary = {'upstream_requests': server.requests}
+        if options['json']:
+            self.stdout.write(json.dumps({'scenarios': results, **results_summary}, indent=2))
+        else:
+            self.stdout.write(format_report(results))
+            self.stdout.write(f"Upstream LLM requests: {server.requests}")
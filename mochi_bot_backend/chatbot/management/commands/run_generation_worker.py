@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from chatbot.jobs import run_worker
+
+class Command(BaseCommand):
+    help = 'Process queued chatbot generation jobs (for CHATBOT_JOB_BACKEND=db)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=None, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the current queue and exit')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Generation worker started'))
+        run_worker(poll_interval=options['poll_interval'], once=options['once'])
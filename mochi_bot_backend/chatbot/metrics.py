@@ -0,0 +1,337 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class RequestMetrics:
+    """What one request spent on the database and upstream LLM calls, filled in while it runs."""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+
+class GenerationUsage:
+    """Upstream tokens spent on one reply, stored on its Message.metadata under 'usage'."""
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.cache_creation_input_tokens = 0
+
+    def as_metadata(self):
+        # Replies served from the response cache or shared with a concurrent request cost nothing
+        if not (self.input_tokens or self.output_tokens):
+            return {}
+        return {'usage': dict(vars(self))}
+
+
+# The request being served in the current context. Context variables follow sync_to_async into its
+# worker threads, so queries and upstream calls made on behalf of async views are attributed as well.
+current_request_metrics: ContextVar = ContextVar('current_request_metrics', default=None)
+
+# The reply being generated in the current context, if its usage is to be kept
+current_generation_usage: ContextVar = ContextVar('current_generation_usage', default=None)
+
+
+@contextmanager
+def collect_usage():
+    """Collect the usage of the upstream calls made inside the block, for the reply they produce."""
+    usage = GenerationUsage()
+    previous = current_generation_usage.get()
+    current_generation_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        # Not reset with a token: around a streamed reply, each chunk may be made in a context of its own
+        current_generation_usage.set(previous)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def describe(self):
+        return {'type': self.type, 'help': self.documentation, 'labelnames': list(self.labelnames)}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A current value. With several worker processes each one reports its own, labelled with its pid."""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            # Per-bucket counts (not cumulative), then the sum and count of all observations
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def describe(self):
+        return dict(super().describe(), buckets=list(self.buckets))
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics, exported in the Prometheus text format.
+
+    With CHATBOT_METRICS['MULTIPROCESS_DIR'] set, every process also writes its values to a file of its own
+    there (at most once per FLUSH_INTERVAL, and at exit), and render() adds up the files of all processes,
+    so whichever gunicorn worker answers the scrape reports the whole server. Clear the directory when the
+    server restarts.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._metrics = {}
+        self._flushed_at = 0.0
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: dict(metric.describe(), values=[[list(key), value] for key, value in metric.values.items()])
+                for name, metric in self._metrics.items()
+            }
+
+    @property
+    def multiprocess_dir(self):
+        return settings.CHATBOT_METRICS['MULTIPROCESS_DIR']
+
+    def flush(self, force=False):
+        directory = self.multiprocess_dir
+        now = time.monotonic()
+        if not directory or (not force and now - self._flushed_at < settings.CHATBOT_METRICS['FLUSH_INTERVAL']):
+            return
+        self._flushed_at = now
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temporary, path)
+
+    def collect(self):
+        """Snapshots of every process as (pid, snapshot) pairs; just this one without a multiprocess directory."""
+        if not self.multiprocess_dir:
+            return [(os.getpid(), self.snapshot())]
+        self.flush(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.multiprocess_dir, 'metrics-*.json')):
+            try:
+                with open(path) as file:
+                    snapshots.append((int(os.path.basename(path)[8:-5]), json.load(file)))
+            except (OSError, ValueError):
+                continue  # Being replaced, or not ours
+        return snapshots
+
+    def render(self):
+        merged = {}
+        multiprocess = bool(self.multiprocess_dir)
+        for pid, snapshot in self.collect():
+            alive = not multiprocess or pid == os.getpid() or _pid_alive(pid)
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, dict(metric, values={}))
+                for labels, value in metric['values']:
+                    if metric['type'] == 'gauge':
+                        # Exited workers' gauges are stale; live ones are told apart by pid
+                        if not alive:
+                            continue
+                        labels = labels + [str(pid)] if multiprocess else labels
+                        target['values'][tuple(labels)] = value
+                    elif metric['type'] == 'histogram':
+                        current = target['values'].get(tuple(labels))
+                        target['values'][tuple(labels)] = (
+                            value if current is None else [a + b for a, b in zip(current, value)]
+                        )
+                    else:
+                        target['values'][tuple(labels)] = target['values'].get(tuple(labels), 0) + value
+
+        lines = []
+        for name in sorted(merged):
+            metric = merged[name]
+            labelnames = metric['labelnames'] + (['pid'] if metric['type'] == 'gauge' and multiprocess else [])
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in sorted(metric['values'].items()):
+                if metric['type'] == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric['buckets'] + [float('inf')], value[:-2]):
+                        cumulative += count
+                        bucket_labels = _format_labels(labelnames, labels, [('le', _format_value(float(bound)))])
+                        lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(labelnames, labels)} {_format_value(value[-2])}')
+                    lines.append(f'{name}_count{_format_labels(labelnames, labels)} {value[-1]}')
+                else:
+                    lines.append(f'{name}{_format_labels(labelnames, labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    'mochi_http_request_duration_seconds', 'Wall time of HTTP requests, until the last byte for streamed responses',
+    ['view', 'method', 'status'],
+)
+http_response_bytes = registry.histogram(
+    'mochi_http_response_bytes', 'Size of HTTP response bodies', ['view'], buckets=BYTES_BUCKETS,
+)
+db_queries_per_request = registry.histogram(
+    'mochi_db_queries_per_request', 'Database queries made while serving a request', ['view'], buckets=QUERY_COUNT_BUCKETS,
+)
+db_query_duration = registry.histogram(
+    'mochi_db_query_duration_seconds_per_request', 'Time a request spent waiting on database queries', ['view'],
+)
+request_llm_duration = registry.histogram(
+    'mochi_llm_duration_seconds_per_request', 'Time a request spent waiting on the upstream LLM', ['view'],
+)
+request_llm_tokens = registry.counter(
+    'mochi_llm_tokens_by_view_total', 'Upstream LLM tokens used by requests, by view', ['view', 'direction'],
+)
+llm_call_duration = registry.histogram(
+    'mochi_llm_call_duration_seconds', 'Duration of upstream LLM calls', ['chatbot_type', 'outcome'],
+)
+llm_tokens = registry.counter(
+    'mochi_llm_tokens_total', 'Upstream LLM tokens by chatbot type', ['chatbot_type', 'direction'],
+)
+response_cache_requests = registry.counter(
+    'mochi_response_cache_requests_total', 'Response cache lookups', ['result'],
+)
+
+
+def record_llm_call(chatbot_type, seconds, input_tokens=0, output_tokens=0, outcome='ok',
+                    cache_read_tokens=0, cache_write_tokens=0):
+    """
+    Record an upstream LLM call globally, against the request that made it and against the reply being
+    generated. input_tokens excludes the prompt-cache reads and writes, which are counted separately.
+    """
+    llm_call_duration.observe(seconds, chatbot_type=chatbot_type, outcome=outcome)
+    llm_tokens.inc(input_tokens, chatbot_type=chatbot_type, direction='input')
+    llm_tokens.inc(output_tokens, chatbot_type=chatbot_type, direction='output')
+    llm_tokens.inc(cache_read_tokens, chatbot_type=chatbot_type, direction='cache_read')
+    llm_tokens.inc(cache_write_tokens, chatbot_type=chatbot_type, direction='cache_write')
+    usage = current_generation_usage.get()
+    if usage is not None:
+        usage.input_tokens += input_tokens
+        usage.output_tokens += output_tokens
+        usage.cache_read_input_tokens += cache_read_tokens
+        usage.cache_creation_input_tokens += cache_write_tokens
+    request_metrics = current_request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.llm_calls += 1
+        request_metrics.llm_seconds += seconds
+        request_metrics.input_tokens += input_tokens
+        request_metrics.output_tokens += output_tokens
+
+
+def count_query(execute, sql, params, many, context):
+    """Database execute wrapper that charges each query's time to the request being served, if any."""
+    request_metrics = current_request_metrics.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_metrics.queries += 1
+        request_metrics.query_seconds += time.perf_counter() - start
+
+
+def install_query_counter(sender, connection, **kwargs):
+    # connection_created handler: every new connection counts its queries for the rest of its life
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
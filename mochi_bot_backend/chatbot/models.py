@@ -1,59 +1,60 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 import uuid
-from django.conf import settings
-from importlib import import_module  # Import import_module
+import hashlib
+import json
 from django.core.exceptions import ValidationError
+from asgiref.sync import sync_to_async
+from .schema_registry import CompiledSchema, schema_registry
 
 class ChatbotSettingsSchema(models.Model):
     chatbot_type = models.CharField(max_length=50, unique=True)
     schema = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def compile(self):
+        return CompiledSchema(self.chatbot_type, self.schema)
 
     def convert_value(self, key, value):
-        if key not in self.schema:
-            return value
-        
-        setting_type = self.schema[key]['type']
-        if setting_type == 'number':
-            try:
-                return float(value)
-            except (ValueError, TypeError):
-                return self.schema[key]['default']
-        elif setting_type == 'string':
-            return str(value)
-        elif setting_type == 'boolean':
-            return bool(value)
-        return value
+        return self.compile().convert_value(key, value)
 
     def validate_setting(self, key, value):
-        if key not in self.schema:
-            raise ValidationError(f"Unknown setting '{key}' for chatbot type '{self.chatbot_type}'")
-        
-        schema_setting = self.schema[key]
-        converted_value = self.convert_value(key, value)
-        
-        if schema_setting['type'] == 'number':
-            if not isinstance(converted_value, (int, float)):
-                raise ValidationError(f"Setting '{key}' must be a number")
-            if 'minimum' in schema_setting and converted_value < schema_setting['minimum']:
-                raise ValidationError(f"Setting '{key}' must be at least {schema_setting['minimum']}")
-            if 'maximum' in schema_setting and converted_value > schema_setting['maximum']:
-                raise ValidationError(f"Setting '{key}' must be at most {schema_setting['maximum']}")
-        elif schema_setting['type'] == 'string' and not isinstance(converted_value, str):
-            raise ValidationError(f"Setting '{key}' must be a string")
-        elif schema_setting['type'] == 'boolean' and not isinstance(converted_value, bool):
-            raise ValidationError(f"Setting '{key}' must be a boolean")   
-            
+        self.compile().validate_setting(key, value)
+
 class ChatbotSettingsDict:
+    """
+    Dict-like view over a chatbot's settings.
+
+    All settings and the type's schema are loaded on first access and served from memory afterwards.
+    Writes are staged and persisted in one batch by flush(), which Chatbot.save() calls.
+    """
+
     def __init__(self, chatbot):
         self.chatbot = chatbot
+        self._settings = None
+        self._schema = None
+        self._dirty = set()
+
+    def _load(self):
+        if self._settings is None:
+            if self.chatbot._state.adding:
+                self._settings = {}
+            else:
+                self._settings = {setting.key: setting for setting in self.chatbot.chatbot_settings.all()}
+            self._schema = schema_registry.get(self.chatbot.chatbot_type)
+        return self._settings
+
+    def _convert(self, key, value):
+        if self._schema is None:
+            return value
+        return self._schema.convert_value(key, value)
 
     def get(self, key, default=None):
-        try:
-            setting = ChatbotSetting.objects.get(chatbot=self.chatbot, key=key)
-            return setting.get_value()
-        except ChatbotSetting.DoesNotExist:
+        setting = self._load().get(key)
+        if setting is None:
             return default
+        return self._convert(key, setting.value)
 
     def __getitem__(self, key):
         value = self.get(key)
@@ -62,9 +63,42 @@ class ChatbotSettingsDict:
         return value
 
     def __setitem__(self, key, value):
-        setting, created = ChatbotSetting.objects.get_or_create(chatbot=self.chatbot, key=key)
-        setting.set_value(value)
-        setting.save()
+        settings = self._load()
+        setting = settings.get(key)
+        if setting is None:
+            setting = settings[key] = ChatbotSetting(chatbot=self.chatbot, key=key)
+        setting.value = self._convert(key, value)
+        self._dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def update(self, values):
+        for key, value in values.items():
+            self[key] = value
+
+    def items(self):
+        return [(key, self._convert(key, setting.value)) for key, setting in self._load().items()]
+
+    def raw(self):
+        return {key: setting.value for key, setting in self._load().items()}
+
+    @property
+    def version(self):
+        """A digest of the stored values; changes whenever any setting does."""
+        return hashlib.sha1(json.dumps(self.raw(), sort_keys=True, default=str).encode()).hexdigest()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        dirty = [self._settings[key] for key in self._dirty]
+        created = [setting for setting in dirty if setting.pk is None]
+        updated = [setting for setting in dirty if setting.pk is not None]
+        if created:
+            ChatbotSetting.objects.bulk_create(created)
+        if updated:
+            ChatbotSetting.objects.bulk_update(updated, ['value'])
+        self._dirty.clear()
 
 class Chatbot(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -78,37 +112,51 @@ class Chatbot(models.Model):
 
     @property
     def settings(self):
-        return ChatbotSettingsDict(self)
+        if '_settings_dict' not in self.__dict__:
+            self._settings_dict = ChatbotSettingsDict(self)
+        return self._settings_dict
+
+    @settings.setter
+    def settings(self, values):
+        self.settings.update(values)
 
     def get_setting(self, key, default=None):
         return self.settings.get(key, default)
 
 
     def generate_response(self, message_content: str, thread_id: str) -> str:
-        chatbot_class = self.get_chatbot_class()
-        chatbot_instance = chatbot_class(self.to_dict())
-        return chatbot_instance.generate_response(message_content, thread_id)
+        return self.get_chatbot_instance().generate_response(message_content, thread_id)
+
+    def stream_response(self, message_content: str, thread_id: str):
+        return self.get_chatbot_instance().stream_response(message_content, thread_id)
+
+    async def agenerate_response(self, message_content: str, thread_id: str) -> str:
+        chatbot_instance = await sync_to_async(self.get_chatbot_instance)()
+        return await chatbot_instance.agenerate_response(message_content, thread_id)
+
+    def get_chatbot_instance(self):
+        from .factory import ChatbotFactory  # Import here to avoid circular import
+        return ChatbotFactory.get_chatbot_instance(self)
 
     def get_chatbot_class(self):
-        chatbot_type = self.chatbot_type
-        class_path = settings.CHATBOT_TYPES[chatbot_type]['class']
-        module_name, class_name = class_path.rsplit('.', 1)
-        module = import_module(module_name)
-        return getattr(module, class_name)
-        
-    @property
-    def settings(self):
-        return ChatbotSettingsDict(self)
+        from .factory import ChatbotFactory  # Import here to avoid circular import
+        return ChatbotFactory.get_chatbot_class(self.chatbot_type)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if '_settings_dict' in self.__dict__:
+            self._settings_dict.flush()
 
     def to_dict(self):
         return {
             'id': str(self.id),
             'name': self.name,
             'desc': self.desc,
-            'owner_id': str(self.owner.id),
+            'owner_id': str(self.owner_id),
             'created_at': self.created_at.isoformat(),
             'chatbot_type': self.chatbot_type,
-            'settings': {setting.key: setting.value for setting in self.chatbot_settings.all()},
+            'settings': self.settings.raw(),
+            'settings_version': self.settings.version,
             'visible': self.visible,
             'guest_allowed': self.guest_allowed,
         }
@@ -121,14 +169,20 @@ class ChatbotSetting(models.Model):
     class Meta:
         unique_together = ('chatbot', 'key')
 
-    def get_value(self):
-        schema = ChatbotSettingsSchema.objects.get(chatbot_type=self.chatbot.chatbot_type)
+    def get_value(self, schema=None):
+        schema = schema or self._get_schema()
         return schema.convert_value(self.key, self.value)
 
-    def set_value(self, new_value):
-        schema = ChatbotSettingsSchema.objects.get(chatbot_type=self.chatbot.chatbot_type)
+    def set_value(self, new_value, schema=None):
+        schema = schema or self._get_schema()
         self.value = schema.convert_value(self.key, new_value)
 
+    def _get_schema(self):
+        schema = schema_registry.get(self.chatbot.chatbot_type)
+        if schema is None:
+            raise ChatbotSettingsSchema.DoesNotExist(f"No settings schema for chatbot type '{self.chatbot.chatbot_type}'")
+        return schema
+
 
 class Thread(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -138,11 +192,108 @@ class Thread(models.Model):
     metadata = models.JSONField(default=dict)
     visible = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            # Serves per-chatbot thread listings such as the chat logs
+            models.Index(fields=['chatbot', 'visible', 'created_at']),
+        ]
+
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
     role = models.CharField(max_length=50)
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set when the message is built rather than saved: a turn's user message is written with the reply
+    created_at = models.DateTimeField(default=timezone.now)
     metadata = models.JSONField(default=dict)
-    visible = models.BooleanField(default=True)
\ No newline at end of file
+    visible = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            # Serves the recent-history window, the incremental summary fold and message listings
+            models.Index(fields=['thread', 'created_at']),
+        ]
+class GenerationJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    chatbot = models.ForeignKey(Chatbot, on_delete=models.CASCADE)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    user_message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='+')
+    assistant_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    error = models.TextField(blank=True)
+    # The rate limit slots of the request that enqueued the job (Admission.hand_off()), freed when it finishes
+    rate_limit = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Lets database-backed workers pick the oldest queued job cheaply
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+class Blob(models.Model):
+    """Stored file contents, shared by every document with the same SHA-256 and deleted when the last one goes."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class Document(models.Model):
+    """A file uploaded to a chatbot, processed in the background from its staged upload into the blob store and index."""
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    chatbot = models.ForeignKey(Chatbot, on_delete=models.CASCADE, related_name='documents')
+    name = models.CharField(max_length=255)
+    # The staged upload until processing moves it into the blob store, then the blob's path
+    path = models.CharField(max_length=255)
+    sha256 = models.CharField(max_length=64, blank=True)
+    size = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    error = models.TextField(blank=True)
+    chunk_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chatbot', 'created_at']),
+            # Lets database-backed workers pick the oldest queued document cheaply
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def to_dict(self):
+        return {
+            'id': str(self.id),
+            'name': self.name,
+            'path': self.path,
+            'sha256': self.sha256,
+            'size': self.size,
+            'status': self.status,
+            'error': self.error,
+            'chunk_count': self.chunk_count,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+        }
@@ -0,0 +1,202 @@
+import math
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from .metrics import current_request_metrics, registry
+
+# How long a bucket's state lock may be held; it expires by itself if its holder dies
+LOCK_TIMEOUT = 5
+# Attempts (1 ms apart) at taking a bucket's state lock before updating it without one
+LOCK_ATTEMPTS = 50
+
+rate_limit_rejections = registry.counter(
+    'mochi_rate_limit_rejections_total', 'Chat requests rejected with 429, by scope and limit', ['scope', 'limit'],
+)
+
+
+class RateLimited(Exception):
+    def __init__(self, scope, limit, retry_after):
+        super().__init__(f'{scope} {limit} limit exceeded')
+        self.scope = scope
+        self.limit = limit
+        self.retry_after = max(math.ceil(retry_after), 1)
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def scopes_for(user, ip, chatbot_id):
+    """The buckets a chat request draws on: its user (or, for guests, its IP) and its chatbot."""
+    if user is not None and user.is_authenticated:
+        caller = ('user', f'user:{user.id}')
+    else:
+        caller = ('guest', f'guest:{ip}')
+    return [caller, ('chatbot', f'chatbot:{chatbot_id}')]
+
+
+class RateLimiter:
+    """
+    Token buckets and concurrency quotas for chat requests, kept in the Django cache named by
+    CHATBOT_RATE_LIMITS['ALIAS'] so every worker sharing that cache shares the limits.
+
+    Each scope (a user, a guest IP, a chatbot) has one cache entry holding a bucket of requests, refilled at
+    REQUESTS_PER_MINUTE, a bucket of upstream tokens refilled at TOKENS_PER_MINUTE, and the leases of its
+    generations in progress, at most CONCURRENT. A request needs a request token, a non-empty token bucket
+    and a free lease in every scope; the upstream tokens it actually used are charged when it's released,
+    so a costly reply can leave the bucket in debt. A limit of 0 is no limit.
+    """
+
+    @property
+    def cache(self):
+        return caches[settings.CHATBOT_RATE_LIMITS['ALIAS']]
+
+    @property
+    def enabled(self):
+        return settings.CHATBOT_RATE_LIMITS['ENABLED']
+
+    def admit(self, user, ip, chatbot_id, estimated_tokens=0):
+        """Take a slot in every scope of the request, or raise RateLimited without taking any."""
+        admission = Admission(self, estimated_tokens)
+        if not self.enabled:
+            return admission
+        try:
+            for scope, key in scopes_for(user, ip, chatbot_id):
+                self._update(scope, key, lambda state: self._take(scope, state, admission.lease))
+                admission.keys.append((scope, key))
+        except RateLimited as error:
+            rate_limit_rejections.inc(scope=error.scope, limit=error.limit)
+            admission.release(refund=True)
+            raise
+        return admission
+
+    def _take(self, scope, state, lease):
+        limits = settings.CHATBOT_RATE_LIMITS[scope.upper()]
+        now = time.time()
+        leases = {key: expiry for key, expiry in state['leases'].items() if expiry > now}
+        if limits['CONCURRENT'] and len(leases) >= limits['CONCURRENT']:
+            raise RateLimited(scope, 'concurrency', 1)
+        if limits['REQUESTS_PER_MINUTE'] and state['requests'] < 1:
+            raise RateLimited(scope, 'requests', (1 - state['requests']) * 60 / limits['REQUESTS_PER_MINUTE'])
+        if limits['TOKENS_PER_MINUTE'] and state['tokens'] <= 0:
+            raise RateLimited(scope, 'tokens', (1 - state['tokens']) * 60 / limits['TOKENS_PER_MINUTE'])
+        state['requests'] -= 1
+        leases[lease] = now + settings.CHATBOT_RATE_LIMITS['LEASE_TIMEOUT']
+        state['leases'] = leases
+
+    def _refill(self, scope, state):
+        limits = settings.CHATBOT_RATE_LIMITS[scope.upper()]
+        now = time.time()
+        elapsed = max(now - state['at'], 0)
+        state['requests'] = min(state['requests'] + elapsed * limits['REQUESTS_PER_MINUTE'] / 60,
+                                limits['REQUESTS_PER_MINUTE'])
+        state['tokens'] = min(state['tokens'] + elapsed * limits['TOKENS_PER_MINUTE'] / 60, limits['TOKENS_PER_MINUTE'])
+        state['at'] = now
+
+    def _update(self, scope, key, change):
+        limits = settings.CHATBOT_RATE_LIMITS[scope.upper()]
+        with self._locked(key):
+            state = self.cache.get(key) or {
+                'requests': limits['REQUESTS_PER_MINUTE'], 'tokens': limits['TOKENS_PER_MINUTE'],
+                'at': time.time(), 'leases': {},
+            }
+            self._refill(scope, state)
+            change(state)
+            # Entries of idle scopes expire, and a missing entry starts out with full buckets
+            self.cache.set(key, state, settings.CHATBOT_RATE_LIMITS['LEASE_TIMEOUT'] + 60)
+
+    def _locked(self, key):
+        return _CacheLock(self.cache, f'{key}:lock')
+
+
+class _CacheLock:
+    # cache.add() only succeeds for one caller, on the local-memory, database and memcached/redis backends alike
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.held = False
+
+    def __enter__(self):
+        for _ in range(LOCK_ATTEMPTS):
+            if self.cache.add(self.key, 1, LOCK_TIMEOUT):
+                self.held = True
+                return self
+            time.sleep(0.001)
+        return self  # Contended for too long; a lost update only lets a request or two slip through
+
+    def __exit__(self, *exc_info):
+        if self.held:
+            self.cache.delete(self.key)
+
+
+class Admission:
+    """The slots a request holds while it generates; release() frees them and charges the tokens used."""
+
+    def __init__(self, limiter, estimated_tokens=0):
+        self.limiter = limiter
+        self.estimated_tokens = estimated_tokens
+        self.lease = uuid.uuid4().hex
+        self.keys = []
+        # Upstream tokens are read off the request's metrics, which record_llm_call fills in
+        self.request_metrics = current_request_metrics.get()
+        self.tokens_before = self._tokens_so_far()
+        self.released = False
+
+    def _tokens_so_far(self):
+        if self.request_metrics is None:
+            return 0
+        return self.request_metrics.input_tokens + self.request_metrics.output_tokens
+
+    def hand_off(self):
+        """
+        Give the slots to whoever finishes the work, e.g. a background job: returns what resume() needs and
+        makes this admission's release() a no-op. The leases still expire after LEASE_TIMEOUT if nobody
+        releases them.
+        """
+        self.released = True
+        return {'lease': self.lease, 'keys': self.keys, 'estimated_tokens': self.estimated_tokens}
+
+    @classmethod
+    def resume(cls, limiter, state):
+        """Take over an admission given away with hand_off()."""
+        admission = cls(limiter, state.get('estimated_tokens', 0))
+        admission.request_metrics = None
+        admission.lease = state['lease']
+        admission.keys = [tuple(scope_key) for scope_key in state.get('keys', [])]
+        return admission
+
+    def release(self, refund=False, used_tokens=None):
+        """
+        Free the request's leases. refund=True also returns its request tokens (it never ran); otherwise
+        used_tokens are charged if given, else the upstream tokens the request used, or the admission's
+        estimate when request metrics are off.
+        """
+        if self.released:
+            return
+        self.released = True
+        if refund:
+            used = 0
+        elif used_tokens is not None:
+            used = used_tokens
+        elif self.request_metrics:
+            used = self._tokens_so_far() - self.tokens_before
+        else:
+            used = self.estimated_tokens
+
+        def change(state):
+            state['leases'].pop(self.lease, None)
+            if refund:
+                state['requests'] += 1
+            state['tokens'] -= used
+
+        for scope, key in self.keys:
+            self.limiter._update(scope, key, change)
+
+
+def estimate_tokens(*texts):
+    # About four characters per token for English text
+    return sum(len(text or '') for text in texts) // 4
+
+
+rate_limiter = RateLimiter()
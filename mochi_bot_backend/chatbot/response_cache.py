@@ -0,0 +1,94 @@
+import hashlib
+import json
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from .metrics import response_cache_requests
+
+
+def message_text(content):
+    # Content is a string, or a list of blocks when it carries a prompt-cache breakpoint
+    if isinstance(content, str):
+        return content
+    return '\n'.join(block.get('text', '') for block in content)
+
+
+def normalize_history(history):
+    # Whitespace differences (and cache breakpoints) don't change the answer, so they shouldn't miss the cache
+    return [{'role': message['role'], 'content': ' '.join(message_text(message['content']).split())} for message in history]
+
+
+class ResponseCache:
+    """
+    Cache of generated replies for chatbots whose output is fully determined by their input.
+
+    Entries live in the Django cache named by CHATBOT_RESPONSE_CACHE['ALIAS'], which handles TTL and eviction,
+    and are keyed by a hash of (chatbot type, settings version, normalized request). Only successful replies
+    are stored: generate() is expected to raise on upstream errors.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[settings.CHATBOT_RESPONSE_CACHE['ALIAS']]
+
+    def is_enabled_for(self, chatbot):
+        return settings.CHATBOT_RESPONSE_CACHE['ENABLED'] and chatbot.is_deterministic()
+
+    def make_key(self, chatbot, history, extra=None):
+        payload = {
+            'chatbot_type': chatbot.chatbot_type,
+            'settings_version': chatbot.settings_version,
+            'history': normalize_history(history),
+            'extra': extra,
+        }
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+        return f'chatbot-response:{digest}'
+
+    def get(self, key):
+        response = self.cache.get(key)
+        self._count(response is not None)
+        return response
+
+    def set(self, key, response):
+        self.cache.set(key, response, settings.CHATBOT_RESPONSE_CACHE['TIMEOUT'])
+
+    def get_or_generate(self, chatbot, history, generate, extra=None):
+        if not self.is_enabled_for(chatbot):
+            return generate()
+        key = self.make_key(chatbot, history, extra)
+        response = self.get(key)
+        if response is None:
+            response = generate()
+            self.set(key, response)
+        return response
+
+    async def aget_or_generate(self, chatbot, history, agenerate, extra=None):
+        if not self.is_enabled_for(chatbot):
+            return await agenerate()
+        key = self.make_key(chatbot, history, extra)
+        response = await self.cache.aget(key)
+        self._count(response is not None)
+        if response is None:
+            response = await agenerate()
+            await self.cache.aset(key, response, settings.CHATBOT_RESPONSE_CACHE['TIMEOUT'])
+        return response
+
+    def _count(self, hit):
+        response_cache_requests.inc(result='hit' if hit else 'miss')
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,306 @@
+import fcntl
+import functools
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import uuid
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from importlib import import_module
+from itertools import islice
+from typing import Iterable, List, Sequence, Tuple
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+')
+
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from has have in is it its of on or that the this to was were will with'.split()
+)
+
+# Rows scored per matrix product during search; bounds the scratch memory of a query whatever the index size
+SEARCH_BLOCK_ROWS = 32768
+
+# Chunks embedded and appended per write while indexing a document
+EMBED_BATCH_SIZE = 256
+
+
+class HashingEmbedder:
+    """
+    Offline embedder that hashes word unigrams and bigrams into a fixed number of signed buckets.
+
+    Needs no model or vocabulary, so documents can be indexed the moment they're uploaded. Any object with
+    a `dimensions` attribute and an `embed(texts)` method returning L2-normalized float32 rows can replace it
+    through CHATBOT_RETRIEVAL['EMBEDDER'].
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or settings.CHATBOT_RETRIEVAL['DIMENSIONS']
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = [token for token in TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS]
+            features = Counter(tokens)
+            features.update(f'{first} {second}' for first, second in zip(tokens, tokens[1:]))
+            for feature, count in features.items():
+                bucket = zlib.crc32(feature.encode())
+                sign = 1.0 if bucket & 0x80000000 else -1.0
+                vectors[row, bucket % self.dimensions] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedder():
+    module_name, class_name = settings.CHATBOT_RETRIEVAL['EMBEDDER'].rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)()
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class VectorIndex:
+    """
+    Append-only, memory-mapped vector index for one chatbot's documents.
+
+    Each generation directory holds the float32 vectors (one row per chunk), the (offset, length) span of
+    every chunk in the concatenated chunk text, and the source document of every row. meta.json records the
+    current generation and how much of each file is committed, so readers never see a half-written batch
+    and a crashed writer's tail is truncated by the next one. Writers serialize on a lock file; removing a
+    document writes a new generation without its rows and swaps meta.json over to it.
+    """
+
+    def __init__(self, chatbot_id, root=None):
+        self.path = os.path.join(root or settings.CHATBOT_RETRIEVAL['INDEX_ROOT'], str(chatbot_id))
+
+    def _file(self, generation, name):
+        return os.path.join(self.path, generation, name)
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        temporary = os.path.join(self.path, f'meta.json.{uuid.uuid4().hex}')
+        with open(temporary, 'w') as file:
+            json.dump(meta, file)
+        os.replace(temporary, os.path.join(self.path, 'meta.json'))
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _new_generation(self, dimensions):
+        meta = {
+            'generation': uuid.uuid4().hex, 'dimensions': dimensions, 'count': 0, 'text_bytes': 0, 'source_bytes': 0,
+            'sources': {},
+        }
+        os.makedirs(os.path.join(self.path, meta['generation']))
+        return meta
+
+    def add(self, source: str, chunks: Iterable[str], embedder=None) -> int:
+        """Embed and append chunks of the document `source`, unless it's indexed already. Returns the number of rows added."""
+        embedder = embedder or get_embedder()
+        with self._locked():
+            meta = self.read_meta()
+            if meta is None:
+                meta = self._new_generation(embedder.dimensions)
+                self._write_meta(meta)
+            elif meta['dimensions'] != embedder.dimensions:
+                raise ValueError(
+                    f"Index has {meta['dimensions']} dimensions but the embedder produces {embedder.dimensions}"
+                )
+            if source in meta['sources']:
+                return 0
+
+            generation = meta['generation']
+            committed = {
+                'vectors.f32': meta['count'] * meta['dimensions'] * 4,
+                'spans.i64': meta['count'] * 16,
+                'chunks.txt': meta['text_bytes'],
+                'sources.txt': meta['source_bytes'],
+            }
+            files = {}
+            try:
+                for name, size in committed.items():
+                    files[name] = open(self._file(generation, name), 'ab')
+                    files[name].truncate(size)
+
+                added = 0
+                offset = meta['text_bytes']
+                for batch in _batched(chunks, EMBED_BATCH_SIZE):
+                    encoded = [chunk.encode() for chunk in batch]
+                    spans = np.empty((len(encoded), 2), dtype=np.int64)
+                    for row, data in enumerate(encoded):
+                        spans[row] = (offset, len(data))
+                        offset += len(data)
+                    files['vectors.f32'].write(np.ascontiguousarray(embedder.embed(batch), dtype=np.float32).tobytes())
+                    files['spans.i64'].write(spans.tobytes())
+                    files['chunks.txt'].write(b''.join(encoded))
+                    files['sources.txt'].write(f'{source}\n'.encode() * len(encoded))
+                    added += len(encoded)
+            finally:
+                for file in files.values():
+                    file.close()
+
+            if added:
+                meta['count'] += added
+                meta['text_bytes'] = offset
+                meta['source_bytes'] += len(f'{source}\n'.encode()) * added
+                meta['sources'][source] = added
+                self._write_meta(meta)
+            return added
+
+    def remove(self, source: str) -> int:
+        """Drop every row of the document `source`. Returns the number of rows removed."""
+        with self._locked():
+            meta = self.read_meta()
+            if not meta or source not in meta['sources']:
+                return 0
+
+            generation = meta['generation']
+            with open(self._file(generation, 'sources.txt'), 'rb') as file:
+                sources = file.read(meta['source_bytes']).decode().splitlines()
+            keep = np.fromiter((row_source != source for row_source in sources), dtype=bool, count=meta['count'])
+            removed = int(meta['count'] - keep.sum())
+            if not removed:
+                return 0
+
+            new_meta = self._new_generation(meta['dimensions'])
+            vectors, spans = self._open(meta)
+            kept_rows = np.flatnonzero(keep)
+            with open(self._file(generation, 'chunks.txt'), 'rb') as old_text, \
+                    open(self._file(new_meta['generation'], 'vectors.f32'), 'wb') as new_vectors, \
+                    open(self._file(new_meta['generation'], 'spans.i64'), 'wb') as new_spans, \
+                    open(self._file(new_meta['generation'], 'chunks.txt'), 'wb') as new_text:
+                offset = 0
+                for start in range(0, len(kept_rows), SEARCH_BLOCK_ROWS):
+                    rows = kept_rows[start:start + SEARCH_BLOCK_ROWS]
+                    new_vectors.write(np.ascontiguousarray(vectors[rows]).tobytes())
+                    block_spans = np.array(spans[rows])
+                    for row, (text_offset, length) in enumerate(block_spans):
+                        old_text.seek(text_offset)
+                        new_text.write(old_text.read(length))
+                        block_spans[row, 0] = offset
+                        offset += int(length)
+                    new_spans.write(block_spans.tobytes())
+            kept_sources = ''.join(f'{sources[row]}\n' for row in kept_rows).encode()
+            with open(self._file(new_meta['generation'], 'sources.txt'), 'wb') as new_sources:
+                new_sources.write(kept_sources)
+
+            new_meta.update(count=len(kept_rows), text_bytes=offset, source_bytes=len(kept_sources))
+            new_meta['sources'] = {key: rows for key, rows in meta['sources'].items() if key != source}
+            self._write_meta(new_meta)
+            # Readers that already mapped the old files keep them until they're done
+            shutil.rmtree(os.path.join(self.path, generation), ignore_errors=True)
+            return removed
+
+    def drop(self):
+        with self._locked():
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def _open(self, meta):
+        shape = (meta['count'], meta['dimensions'])
+        vectors = np.memmap(self._file(meta['generation'], 'vectors.f32'), dtype=np.float32, mode='r', shape=shape)
+        spans = np.memmap(self._file(meta['generation'], 'spans.i64'), dtype=np.int64, mode='r', shape=(meta['count'], 2))
+        return vectors, spans
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[float, str]]]:
+        """
+        Return the k chunks most similar to each query vector as (cosine score, text), best first.
+
+        Rows are scored a block at a time with one matrix product for the whole batch of queries, and only
+        each block's top k survive into the next round, so memory stays flat as the index grows.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        for attempt in range(2):
+            meta = self.read_meta()
+            if not meta or not meta['count']:
+                return [[] for _ in queries]
+            try:
+                vectors, spans = self._open(meta)
+                text = open(self._file(meta['generation'], 'chunks.txt'), 'rb')
+                break
+            except FileNotFoundError:
+                # A removal swapped generations between reading meta.json and opening its files
+                if attempt:
+                    raise
+
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, meta['count'], SEARCH_BLOCK_ROWS):
+            scores = queries @ vectors[start:start + SEARCH_BLOCK_ROWS].T
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+
+        results = []
+        with text:
+            for scores, rows in zip(best_scores, best_rows):
+                matches = []
+                for score, row in zip(scores, rows):
+                    offset, length = spans[row]
+                    text.seek(offset)
+                    matches.append((float(score), text.read(length).decode()))
+                results.append(matches)
+        return results
+
+
+def index_document(chatbot_id, source: str, path: str) -> int:
+    from .ingestion import iter_chunks  # Import here to avoid circular import
+
+    return VectorIndex(chatbot_id).add(source, iter_chunks(path))
+
+
+def remove_document(chatbot_id, source: str) -> int:
+    return VectorIndex(chatbot_id).remove(source)
+
+
+def retrieve(chatbot_id, query: str, k: int = None) -> List[str]:
+    """Return the text of the chunks most relevant to `query` from the chatbot's documents, best first."""
+    config = settings.CHATBOT_RETRIEVAL
+    index = VectorIndex(chatbot_id)
+    meta = index.read_meta()
+    if not query.strip() or meta is None:
+        return []
+    embedder = get_embedder()
+    if meta['dimensions'] != embedder.dimensions:
+        logger.warning(
+            "Index of chatbot %s has %d dimensions but the embedder produces %d; run process_documents --reindex",
+            chatbot_id, meta['dimensions'], embedder.dimensions,
+        )
+        return []
+    [matches] = index.search(embedder.embed([query]), k or config['TOP_K'])
+    return [text for score, text in matches if score >= config['MIN_SCORE']]
@@ -0,0 +1,128 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+
+
+def _default_of(spec):
+    # Schemas written by init_chatbot_schemas use 'default_value', the ones in settings use 'default'
+    return spec.get('default', spec.get('default_value'))
+
+
+def _compile_converter(spec: Dict[str, Any]) -> Callable[[Any], Any]:
+    setting_type = spec.get('type')
+    if setting_type == 'number':
+        default = _default_of(spec)
+
+        def convert(value):
+            try:
+                return float(value)
+            except (ValueError, TypeError):
+                return default
+        return convert
+    if setting_type == 'string':
+        return str
+    if setting_type == 'boolean':
+        return bool
+    return lambda value: value
+
+
+def _compile_validator(key: str, spec: Dict[str, Any]) -> Callable[[Any], None]:
+    setting_type = spec.get('type')
+    checks = []
+    if setting_type == 'number':
+        checks.append((lambda value: isinstance(value, (int, float)), f"Setting '{key}' must be a number"))
+        if 'minimum' in spec:
+            minimum = spec['minimum']
+            checks.append((lambda value: value >= minimum, f"Setting '{key}' must be at least {minimum}"))
+        if 'maximum' in spec:
+            maximum = spec['maximum']
+            checks.append((lambda value: value <= maximum, f"Setting '{key}' must be at most {maximum}"))
+    elif setting_type == 'string':
+        checks.append((lambda value: isinstance(value, str), f"Setting '{key}' must be a string"))
+    elif setting_type == 'boolean':
+        checks.append((lambda value: isinstance(value, bool), f"Setting '{key}' must be a boolean"))
+
+    def validate(value):
+        for check, message in checks:
+            if not check(value):
+                raise ValidationError(message)
+    return validate
+
+
+class CompiledSchema:
+    """A chatbot type's settings schema with per-key converters and validators built once."""
+
+    def __init__(self, chatbot_type: str, schema: Dict[str, Any]):
+        self.chatbot_type = chatbot_type
+        self.schema = schema
+        self._converters = {key: _compile_converter(spec) for key, spec in schema.items()}
+        self._validators = {key: _compile_validator(key, spec) for key, spec in schema.items()}
+
+    def convert_value(self, key, value):
+        converter = self._converters.get(key)
+        if converter is None:
+            return value
+        return converter(value)
+
+    def validate_setting(self, key, value):
+        if key not in self._validators:
+            raise ValidationError(f"Unknown setting '{key}' for chatbot type '{self.chatbot_type}'")
+        self._validators[key](self.convert_value(key, value))
+
+
+class SchemaRegistry:
+    """
+    Process-wide cache of compiled ChatbotSettingsSchema rows.
+
+    Rows are reloaded when their version stamp (row count and latest updated_at) changes. The stamp
+    is checked at most once per CHATBOT_SCHEMA_REGISTRY_CHECK_INTERVAL seconds, so schema updates made
+    by another process reach every worker within that interval.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas = None
+        self._stamp = None
+        self._checked_at = 0.0
+
+    def get(self, chatbot_type: str) -> Optional[CompiledSchema]:
+        return self._current().get(chatbot_type)
+
+    @property
+    def version(self):
+        self._current()
+        return self._stamp
+
+    def invalidate(self):
+        with self._lock:
+            self._schemas = None
+
+    def _current(self) -> Dict[str, CompiledSchema]:
+        schemas = self._schemas
+        now = time.monotonic()
+        if schemas is not None and now - self._checked_at < settings.CHATBOT_SCHEMA_REGISTRY_CHECK_INTERVAL:
+            return schemas
+
+        from .models import ChatbotSettingsSchema  # Import here to avoid circular import
+
+        with self._lock:
+            stamp = ChatbotSettingsSchema.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+            stamp = (stamp['count'], stamp['updated_at'].isoformat() if stamp['updated_at'] else None)
+            if self._schemas is None or stamp != self._stamp:
+                self._schemas = {
+                    row.chatbot_type: CompiledSchema(row.chatbot_type, row.schema)
+                    for row in ChatbotSettingsSchema.objects.all()
+                }
+                self._stamp = stamp
+            self._checked_at = now
+            return self._schemas
+
+
+schema_registry = SchemaRegistry()
+
+
+def invalidate_schema_registry(**kwargs):
+    schema_registry.invalidate()
@@ -37,17 +37,15 @@ class ChatbotSerializer(serializers.ModelSerializer):
         merged_settings = {**default_settings, **settings_data}
 
         chatbot = Chatbot.objects.create(**validated_data)
-        for key, value in merged_settings.items():
-            ChatbotSetting.objects.create(chatbot=chatbot, key=key, value=value)
+        chatbot.settings.update(merged_settings)
+        chatbot.settings.flush()
         return chatbot
 
     def update(self, instance, validated_data):
         settings_data = validated_data.pop('settings', {})
         instance = super().update(instance, validated_data)
-        for key, value in settings_data.items():
-            setting, created = ChatbotSetting.objects.get_or_create(chatbot=instance, key=key)
-            setting.value = value
-            setting.save()
+        instance.settings.update(settings_data)
+        instance.settings.flush()
         return instance
 
 class ThreadSerializer(serializers.ModelSerializer):
@@ -71,16 +69,30 @@ class MessageSerializer(serializers.ModelSerializer):
         rep['thread'] = ThreadSerializer(instance.thread).data  # Serialize thread as object
         return rep
 
-    def validate(self, data):
-        logger.debug(f"Validating message data: {data}")
-        return data
+class CompactMessageSerializer(serializers.BaseSerializer):
+    """
+    Read-only message representation for the chat endpoints: thread_id instead of the nested thread, and
+    built straight from the instance rather than field by field, since every turn serializes two messages.
+    """
+
+    created_at_field = serializers.DateTimeField()
+
+    def to_representation(self, instance):
+        return {
+            'id': str(instance.id),
+            'thread_id': str(instance.thread_id),
+            'role': instance.role,
+            'content': instance.content,
+            'created_at': self.created_at_field.to_representation(instance.created_at),
+            'metadata': instance.metadata,
+            'visible': instance.visible,
+        }
 
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField()
     password = serializers.CharField()
 
     def validate(self, data):
-        logger.debug(f"Validating login data: {data}")
         username = data.get('username')
         password = data.get('password')
 
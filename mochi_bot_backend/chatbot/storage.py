@@ -1,39 +1,191 @@
+import fcntl
 import json
 import os
-from typing import Dict, Any
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Tuple
 
-class JSONFileStorage:
-    def __init__(self, file_path: str):
+# Reading the log tail in pieces of this size keeps index rebuilds from loading the file whole
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+
+class LogStorage:
+    """
+    Key-value store kept as an append-only log with an in-memory offset index.
+
+    Every set appends a `<json key>\\t<json value>` line and every delete a `<json key>` tombstone, so writes
+    cost the size of the record rather than the file. The index maps each live key to the offset of its
+    latest value and is caught up from the log's tail before each operation, which lets several processes
+    share one file; they serialize on a lock file next to it (shared for reads, exclusive for writes).
+
+    Once superseded records make up most of a log larger than `compact_min_bytes`, the next write rewrites
+    it with only the live records. Other processes notice the replaced file and rebuild their index.
+    """
+
+    def __init__(self, file_path: str, compact_min_bytes: int = 1024 * 1024, fsync: bool = False):
         self.file_path = file_path
+        self.compact_min_bytes = compact_min_bytes
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._fd = None
+        self._index: Dict[str, Tuple[int, int, int]] = {}  # key -> (value offset, value length, record length)
+        self._indexed_size = 0
+        self._live_bytes = 0
         self.ensure_file_exists()
 
     def ensure_file_exists(self):
-        if not os.path.exists(self.file_path):
-            with open(self.file_path, 'w') as f:
-                json.dump({}, f)
+        with self._locked(exclusive=True, refresh=False):
+            self._import_legacy_json()
+            self._refresh()
+
+    # Locking and index maintenance
+
+    @contextmanager
+    def _locked(self, exclusive=False, refresh=True):
+        with self._lock, open(f'{self.file_path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                if refresh:
+                    self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.file_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._index = {}
+        self._indexed_size = 0
+        self._live_bytes = 0
+
+    def _refresh(self):
+        # A compaction elsewhere replaces the file, so an open descriptor can point at a stale copy
+        try:
+            replaced = self._fd is None or os.stat(self.file_path).st_ino != os.fstat(self._fd).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            self._open()
+
+        size = os.fstat(self._fd).st_size
+        offset = self._indexed_size
+        pending = b''
+        while offset + len(pending) < size:
+            data = os.pread(self._fd, min(SCAN_CHUNK_SIZE, size - offset - len(pending)), offset + len(pending))
+            if not data:
+                break
+            pending += data
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                self._index_record(offset, line)
+                offset += len(line) + 1
+        # Anything after the last newline is a record still being written, or left over by a crashed writer
+        self._indexed_size = offset
+
+    def _index_record(self, offset, line):
+        key_json, tab, value_json = line.partition(b'\t')
+        key = json.loads(key_json)
+        previous = self._index.pop(key, None)
+        if previous is not None:
+            self._live_bytes -= previous[2]
+        if tab:
+            value_offset = offset + len(key_json) + 1
+            self._index[key] = (value_offset, len(value_json), len(line) + 1)
+            self._live_bytes += len(line) + 1
 
-    def read(self) -> Dict[str, Any]:
-        with open(self.file_path, 'r') as f:
-            return json.load(f)
+    def _append(self, records: bytes):
+        if os.fstat(self._fd).st_size > self._indexed_size:
+            # Drop the partial record of a writer that died mid-append, so ours starts on a fresh line
+            os.truncate(self.file_path, self._indexed_size)
+        os.write(self._fd, records)
+        if self.fsync:
+            os.fsync(self._fd)
+        self._refresh()
+        if self._indexed_size >= self.compact_min_bytes and self._live_bytes * 2 < self._indexed_size:
+            self._compact()
 
-    def write(self, data: Dict[str, Any]):
-        with open(self.file_path, 'w') as f:
-            json.dump(data, f, indent=2)
+    def _compact(self):
+        temporary = f'{self.file_path}.compact'
+        with open(temporary, 'wb') as file:
+            for key, (offset, length, _) in self._index.items():
+                file.write(self._encode_key(key) + b'\t' + os.pread(self._fd, length, offset) + b'\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.file_path)
+        self._open()
+        self._refresh()
+
+    def _import_legacy_json(self):
+        # Files written by the old JSONFileStorage hold one JSON object, while log records start with a quoted key
+        try:
+            with open(self.file_path) as file:
+                if file.read(1) != '{':
+                    return
+                file.seek(0)
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        temporary = f'{self.file_path}.compact'
+        with open(temporary, 'wb') as file:
+            file.write(self._encode_records(data.items()))
+        os.replace(temporary, self.file_path)
+
+    @staticmethod
+    def _encode_key(key: str) -> bytes:
+        return json.dumps(key).encode()
+
+    def _encode_records(self, items: Iterable[Tuple[str, Any]]) -> bytes:
+        return b''.join(self._encode_key(key) + b'\t' + json.dumps(value).encode() + b'\n' for key, value in items)
+
+    def _read_value(self, key):
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        offset, length, _ = entry
+        return json.loads(os.pread(self._fd, length, offset))
+
+    # Public API
 
     def get(self, key: str) -> Any:
-        data = self.read()
-        return data.get(key)
+        with self._locked():
+            return self._read_value(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Return the values of the keys that exist, read under a single lock."""
+        with self._locked():
+            return {key: self._read_value(key) for key in keys if key in self._index}
 
     def set(self, key: str, value: Any):
-        data = self.read()
-        data[key] = value
-        self.write(data)
+        self.set_many({key: value})
+
+    def set_many(self, data: Dict[str, Any]):
+        """Store several keys with one append, so readers see all of them or none."""
+        if not data:
+            return
+        records = self._encode_records(data.items())
+        with self._locked(exclusive=True):
+            self._append(records)
 
     def delete(self, key: str):
-        data = self.read()
-        if key in data:
-            del data[key]
-            self.write(data)
+        with self._locked(exclusive=True):
+            if key in self._index:
+                self._append(self._encode_key(key) + b'\n')
+
+    def list_keys(self) -> List[str]:
+        with self._locked():
+            return list(self._index)
+
+    def compact(self):
+        with self._locked(exclusive=True):
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
 
-    def list_keys(self) -> list:
-        return list(self.read().keys())
\ No newline at end of file
+# The log replaced the single JSON document; existing JSON files are converted on first open
+JSONFileStorage = LogStorage
@@ -0,0 +1,47 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from .models import Message
+
+# The turn whose reply is being generated in the current context, if its user message isn't saved yet
+current_turn: ContextVar = ContextVar('current_turn', default=None)
+
+
+class Turn:
+    """
+    A user message and the reply to it, saved together once the reply is ready.
+
+    The user message is built (and timestamped) when the request arrives, but only written with the reply,
+    in one short transaction: a generation that fails leaves nothing behind, and no transaction is held open
+    while the model runs. During generating(), ContextBuilder adds the unsaved message to the history.
+    """
+
+    def __init__(self, thread, content):
+        self.thread = thread
+        self.user_message = Message(thread=thread, role='user', content=content)
+        self.assistant_message = None
+
+    @contextmanager
+    def generating(self):
+        previous = current_turn.get()
+        current_turn.set(self)
+        try:
+            yield self
+        finally:
+            # Not reset with a token: a streamed reply's generator may be closed from another context
+            current_turn.set(previous)
+
+    def pending_for(self, thread_id):
+        """The unsaved user message, if this turn belongs to thread_id."""
+        return self.user_message if str(self.thread.id) == str(thread_id) else None
+
+    def save(self, content, metadata=None):
+        """Write both messages and return them."""
+        self.assistant_message = Message(thread=self.thread, role='assistant', content=content, metadata=metadata or {})
+        with transaction.atomic():
+            Message.objects.bulk_create([self.user_message, self.assistant_message])
+        return self.user_message, self.assistant_message
+
+    async def asave(self, content, metadata=None):
+        return await sync_to_async(self.save)(content, metadata)
@@ -0,0 +1,309 @@
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from django.conf import settings
+from .jobs import get_executor
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth another attempt: timeouts, conflicts, rate limits and anything the upstream got wrong
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+# Longest Retry-After we'll sit out inside a request; a longer one fails the call instead
+MAX_RETRY_AFTER = 30.0
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+circuit_state = registry.gauge(
+    'mochi_upstream_circuit_state', 'Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open', ['upstream'],
+)
+circuit_rejections = registry.counter(
+    'mochi_upstream_circuit_rejections_total', 'Calls failed fast because the circuit was open', ['upstream'],
+)
+upstream_retries = registry.counter(
+    'mochi_upstream_retries_total', 'Upstream attempts that were retried', ['upstream', 'reason'],
+)
+upstream_hedges = registry.counter(
+    'mochi_upstream_hedges_total', 'Hedged upstream requests, by which attempt answered first', ['upstream', 'winner'],
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that has been failing."""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when an upstream call is still failing and its DEADLINE leaves no time for another attempt."""
+
+
+class UpstreamError(Exception):
+    """A reply couldn't be generated because its upstream call failed. Views answer with `status`, saving nothing."""
+
+    def __init__(self, message='There was an error processing your request. Please try again.', status=502):
+        super().__init__(message)
+        self.status = status
+
+
+def is_timeout(error):
+    return isinstance(error, (TimeoutError, DeadlineExceededError)) or type(error).__name__ in (
+        'APITimeoutError', 'TimeoutException', 'ReadTimeout'
+    )
+
+
+def generation_error(error):
+    """The UpstreamError to fail a reply with after `error`: 503 while the circuit is open, 504 on timeouts."""
+    if isinstance(error, CircuitOpenError):
+        return UpstreamError('The model is unavailable right now. Please try again later.', status=503)
+    if is_timeout(error):
+        return UpstreamError('The model took too long to answer. Please try again.', status=504)
+    return UpstreamError()
+
+
+def status_code_of(error):
+    status = getattr(error, 'status_code', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    return status
+
+
+def is_retryable(error):
+    status = status_code_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    # No response at all: a timeout or a connection that failed or dropped
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in (
+        'APIConnectionError', 'APITimeoutError', 'TimeoutException', 'ConnectError', 'ReadTimeout', 'RemoteProtocolError'
+    )
+
+
+def retry_after(error):
+    """Seconds the upstream asked us to wait before retrying, or None."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(parsed.timestamp() - time.time(), 0.0) if parsed else None
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after FAILURE_THRESHOLD consecutive upstream failures.
+
+    Once RESET_TIMEOUT seconds pass, a single trial call is let through (half-open); its success closes
+    the circuit again and its failure re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._set_state(CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        circuit_state.set(STATE_VALUES[state], upstream=self.name)
+
+    def before_call(self):
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+                self._trial_running = False
+            if self.state == OPEN or (self.state == HALF_OPEN and self._trial_running):
+                circuit_rejections.inc(upstream=self.name)
+                raise CircuitOpenError(f'Upstream {self.name} is unavailable')
+            if self.state == HALF_OPEN:
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            if self.state != CLOSED:
+                logger.info("Circuit for %s closed", self.name)
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning("Circuit for %s opened after %d failures", self.name, self._failures)
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class UpstreamClient:
+    """
+    Calls an upstream API with a timeout per attempt, retries, optional hedging and a circuit breaker.
+
+    `request(timeout)` makes one attempt and must accept the per-attempt timeout in seconds. Retryable
+    failures (429, 5xx, timeouts, dropped connections) are retried with jittered exponential backoff, or
+    after the upstream's Retry-After, until MAX_RETRIES or the overall DEADLINE runs out. With HEDGE_AFTER
+    set, an attempt that hasn't answered by then gets a second copy racing it, and the first answer wins;
+    pass hedge=False for requests whose result holds a connection open, like streams.
+    """
+
+    def __init__(self, name, config=None):
+        self.name = name
+        self.config = {**settings.CHATBOT_UPSTREAM, **(config or {})}
+        self.breaker = CircuitBreaker(name, self.config['BREAKER_FAILURE_THRESHOLD'], self.config['BREAKER_RESET_TIMEOUT'])
+
+    def backoff(self, attempt, error):
+        requested = retry_after(error)
+        if requested is not None:
+            return requested
+        ceiling = min(self.config['BACKOFF_MAX'], self.config['BACKOFF_BASE'] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def _next_delay(self, attempt, error, deadline):
+        """
+        Seconds to wait before the next attempt, or None if the error should be raised instead. Raises
+        DeadlineExceededError if a retry would be due but would end past the deadline.
+        """
+        if not is_retryable(error) or attempt >= self.config['MAX_RETRIES']:
+            return None
+        delay = self.backoff(attempt, error)
+        if delay > MAX_RETRY_AFTER:
+            return None
+        if time.monotonic() + delay >= deadline:
+            raise DeadlineExceededError(f'Upstream {self.name} did not answer within its deadline') from error
+        upstream_retries.inc(upstream=self.name, reason=str(status_code_of(error) or type(error).__name__))
+        return delay
+
+    def _record(self, error):
+        # Requests the upstream rejected on their merits say nothing about its health
+        if error is None or not is_retryable(error):
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _timeout(self, deadline):
+        return max(min(self.config['TIMEOUT'], deadline - time.monotonic()), 0.001)
+
+    def call(self, request, hedge=True):
+        deadline = time.monotonic() + self.config['DEADLINE']
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = self._attempt(request, deadline, hedge)
+            except Exception as error:
+                self._record(error)
+                delay = self._next_delay(attempt, error, deadline)
+                if delay is None:
+                    raise
+                logger.info("Retrying %s in %.2fs after %r", self.name, delay, error)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._record(None)
+            return result
+
+    def _attempt(self, request, deadline, hedge):
+        hedge_after = self.config['HEDGE_AFTER'] if hedge else 0
+        if not hedge_after:
+            return request(self._timeout(deadline))
+
+        # The losing attempt can't be cancelled mid-request, so it finishes in the background and is ignored
+        executor = get_executor('upstream-hedging', self.config['HEDGE_WORKERS'])
+        first = executor.submit(request, self._timeout(deadline))
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        second = executor.submit(request, self._timeout(deadline))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    upstream_hedges.inc(upstream=self.name, winner='primary' if future is first else 'hedge')
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def acall(self, request, hedge=True):
+        """Async counterpart of call(); `request(timeout)` returns an awaitable."""
+        deadline = time.monotonic() + self.config['DEADLINE']
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = await self._aattempt(request, deadline, hedge)
+            except Exception as error:
+                self._record(error)
+                delay = self._next_delay(attempt, error, deadline)
+                if delay is None:
+                    raise
+                logger.info("Retrying %s in %.2fs after %r", self.name, delay, error)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._record(None)
+            return result
+
+    async def _aattempt(self, request, deadline, hedge):
+        hedge_after = self.config['HEDGE_AFTER'] if hedge else 0
+        if not hedge_after:
+            return await request(self._timeout(deadline))
+
+        first = asyncio.ensure_future(request(self._timeout(deadline)))
+        done, _ = await asyncio.wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        second = asyncio.ensure_future(request(self._timeout(deadline)))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        upstream_hedges.inc(upstream=self.name, winner='primary' if task is first else 'hedge')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_upstream(name):
+    """Return the process-wide client for the upstream called name, so all callers share its breaker."""
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = _clients[name] = UpstreamClient(name)
+        return client
+
+
+def reset_upstreams():
+    with _clients_lock:
+        _clients.clear()
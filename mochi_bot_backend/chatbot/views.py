@@ -6,25 +6,42 @@ from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
-from .models import User, Chatbot, Thread, Message, ChatbotSettingsSchema
-from .serializers import UserSerializer, LoginSerializer, ChatbotSerializer, ThreadSerializer, MessageSerializer
+from .models import User, Chatbot, Thread, Message, GenerationJob, Document
+from .serializers import UserSerializer, LoginSerializer, ChatbotSerializer, ThreadSerializer, CompactMessageSerializer
 from .factory import ChatbotFactory
-from .file_handler import save_uploaded_file, delete_file, get_file_url
+from .schema_registry import schema_registry
+from .pagination import keyset_page, parse_page_size
+from .jobs import await_job, enqueue_generation
+from .file_handler import stage_upload, release_blob, delete_file, get_file_url
+from .retrieval import VectorIndex, remove_document
+from .documents import discard_document, enqueue_document, submit_document_task
+from .rate_limits import RateLimited, client_ip, estimate_tokens, rate_limiter
+from .authentication import CachedJWTAuthentication
+from .turns import Turn
+from .upstream import UpstreamError
 logger = logging.getLogger(__name__)
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, HttpResponseNotAllowed
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.decorators.csrf import csrf_exempt
 import json  # Add this import
+import functools
 from django.middleware.csrf import get_token
-from django.db.models import Count
-from rest_framework.exceptions import ValidationError
+from django.db.models import Exists, OuterRef, Prefetch, prefetch_related_objects
+from rest_framework.exceptions import ValidationError, AuthenticationFailed
+from django.core.exceptions import ValidationError as DjangoValidationError
+from asgiref.sync import sync_to_async
+import hmac
+import math
+from django.conf import settings
+from . import metrics as request_metrics
+from mochi_bot_backend.database import replica_reads
+from mochi_bot_backend.structured_logging import bind_chatbot
 
 @csrf_exempt
 def debug_view(request):
     csrf_token = get_token(request)
     headers = request.headers
-    print(f"CSRF Token: {csrf_token}")
-    print(f"Headers: {headers}")
     return JsonResponse({'csrf_token': csrf_token, 'headers': dict(headers)})
     
 class ChatbotViewSet(viewsets.ModelViewSet):
@@ -35,51 +52,103 @@ class ChatbotViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+# Threads fetched per query when building the full logs or the NDJSON export
+LOG_BATCH_SIZE = 200
+
+def _chat_log_threads(chatbot):
+    return Thread.objects.filter(chatbot=chatbot, visible=True).filter(
+        Exists(Message.objects.filter(thread=OuterRef('pk')))
+    ).only('id', 'created_at')
+
+def _chat_log_message(message):
+    return {
+        'id': message.id,
+        'thread_id': message.thread_id,
+        'role': message.role,
+        'content': message.content,
+        'created_at': message.created_at,
+        'metadata': message.metadata,
+        'visible': message.visible,
+    }
+
+def _chat_log_page(chatbot, cursor=None, limit=LOG_BATCH_SIZE):
+    # One query for the page of threads and one for all of their messages
+    threads, next_cursor = keyset_page(_chat_log_threads(chatbot), cursor=cursor, limit=limit)
+    prefetch_related_objects(threads, Prefetch('message_set', queryset=Message.objects.order_by('created_at', 'pk')))
+    logs = [
+        {
+            'thread_id': thread.id,
+            'created_at': thread.created_at,
+            'messages': [_chat_log_message(message) for message in thread.message_set.all()]
+        }
+        for thread in threads
+    ]
+    return logs, next_cursor
+
+def _iter_chat_logs(chatbot):
+    cursor = None
+    while True:
+        logs, cursor = _chat_log_page(chatbot, cursor=cursor)
+        yield from logs
+        if cursor is None:
+            return
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@replica_reads()
 def get_chat_logs(request, chatbot_id):
     chatbot = get_object_or_404(Chatbot, id=chatbot_id, owner=request.user)
-    threads = Thread.objects.filter(chatbot=chatbot, visible=True).annotate(
-        message_count=Count('message')
-    ).filter(message_count__gt=0)
-    
-    logs = []
-    for thread in threads:
-        messages = Message.objects.filter(thread=thread).order_by('created_at')
-        thread_data = {
-            'thread_id': thread.id,
-            'created_at': thread.created_at,
-            'messages': MessageSerializer(messages, many=True).data
-        }
-        logs.append(thread_data)
-    
-    return Response(logs)
+
+    # Without paging parameters the whole log is returned as a list, as before
+    if 'cursor' not in request.query_params and 'limit' not in request.query_params:
+        return Response(list(_iter_chat_logs(chatbot)))
+
+    try:
+        logs, next_cursor = _chat_log_page(
+            chatbot,
+            cursor=request.query_params.get('cursor'),
+            limit=parse_page_size(request.query_params.get('limit'))
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'results': logs, 'next_cursor': next_cursor})
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@replica_reads()
+def export_chat_logs(request, chatbot_id):
+    chatbot = get_object_or_404(Chatbot, id=chatbot_id, owner=request.user)
+
+    def rows():
+        # The rows are read while the response streams, after the view has returned
+        with replica_reads():
+            for log in _iter_chat_logs(chatbot):
+                for message in log['messages']:
+                    yield json.dumps({**message, 'thread_created_at': log['created_at']}, cls=DjangoJSONEncoder) + '\n'
+
+    response = StreamingHttpResponse(rows(), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="chat-logs-{chatbot.id}.ndjson"'
+    return response
      
 @api_view(['GET', 'PUT'])
 @permission_classes([IsAuthenticated])
 def chatbot_settings(request, chatbot_id):
-    logger.debug(f"Accessing chatbot settings for chatbot_id: {chatbot_id}")
-    
     chatbot = get_object_or_404(Chatbot, id=chatbot_id)
-    logger.debug(f"Chatbot found: {chatbot.name}, type: {chatbot.chatbot_type}")
+    logger.debug("Chatbot found: %s, type: %s", chatbot.name, chatbot.chatbot_type)
     
     if not (request.user == chatbot.owner or request.user.is_staff):
-        logger.warning(f"Permission denied for user {request.user.username}")
+        logger.warning("Permission denied for user %s", request.user.id)
         return Response({'error': 'Permission denied'}, status=403)
     
-    try:
-        schema = ChatbotSettingsSchema.objects.get(chatbot_type=chatbot.chatbot_type)
-        logger.debug(f"Schema found for chatbot type: {chatbot.chatbot_type}")
-        logger.debug(f"Schema content: {schema.schema}")
-    except ChatbotSettingsSchema.DoesNotExist:
-        logger.error(f"ChatbotSettingsSchema not found for type: {chatbot.chatbot_type}")
+    schema = schema_registry.get(chatbot.chatbot_type)
+    if schema is None:
+        logger.error("ChatbotSettingsSchema not found for type: %s", chatbot.chatbot_type)
         return Response({'error': f'Settings schema not found for chatbot type: {chatbot.chatbot_type}'}, status=404)
     
     if request.method == "GET":
         settings = {}
         for key, setting_schema in schema.schema.items():
-            logger.debug(f"Processing setting: {key}, schema: {setting_schema}")
-            default_value = setting_schema.get('default', None)
+            default_value = setting_schema.get('default', setting_schema.get('default_value'))
             setting_value = chatbot.settings.get(key, default_value)
             settings[key] = {
                 'value': setting_value,
@@ -89,7 +158,6 @@ def chatbot_settings(request, chatbot_id):
                 'default_value': default_value,
                 'required': setting_schema.get('required', False)
             }
-        logger.debug(f"Returning settings: {settings}")
         return Response(settings)
 
     elif request.method == "PUT":
@@ -98,15 +166,16 @@ def chatbot_settings(request, chatbot_id):
             for key, value in settings_data.items():
                 if key not in schema.schema:
                     return Response({'error': f'Invalid setting: {key}'}, status=400)
-                setting_schema = schema.schema[key]
-                # Validate the setting here if needed
+                schema.validate_setting(key, value)
                 chatbot.settings[key] = value
             chatbot.save()
             return Response({'message': 'Settings updated successfully'})
         except json.JSONDecodeError:
             return Response({'error': 'Invalid JSON'}, status=400)
+        except DjangoValidationError as e:
+            return Response({'error': e.messages[0]}, status=400)
         except Exception as e:
-            logger.error(f"Error updating settings: {str(e)}")
+            logger.exception("Error updating settings")
             return Response({'error': 'An error occurred while updating settings'}, status=500)
 
     return Response({'error': 'Method not allowed'}, status=405)
@@ -150,12 +219,11 @@ def logout_user(request):
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
 def chatbot_list(request):
-    print(f"Request user: {request.user}")
-
     if request.method == 'GET':
-        chatbots = Chatbot.objects.filter(owner=request.user)
-        serializer = ChatbotSerializer(chatbots, many=True)
-        return Response(serializer.data)
+        with replica_reads():
+            chatbots = Chatbot.objects.filter(owner=request.user)
+            serializer = ChatbotSerializer(chatbots, many=True)
+            return Response(serializer.data)
     
     elif request.method == 'POST':
         chatbot_type = request.data.get('chatbot_type')
@@ -164,7 +232,6 @@ def chatbot_list(request):
         
         try:
             chatbot_metadata = ChatbotFactory.get_chatbot_metadata(chatbot_type)
-            logger.info(f"Chatbot metadata for type {chatbot_type}: {chatbot_metadata}")
         except ValueError as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
@@ -177,17 +244,14 @@ def chatbot_list(request):
         if serializer.is_valid():
             # Initialize settings with default values
             initialized_settings = {k: v.get('default', '') for k, v in settings.items()}
-            logger.info(f"Initial settings: {initialized_settings}")
-            
             # Update settings with provided values if any
             if 'settings' in request.data:
                 initialized_settings.update(request.data['settings'])
-                logger.info(f"Updated settings: {initialized_settings}")
             
             chatbot = serializer.save(owner=request.user, chatbot_type=chatbot_type, settings=initialized_settings)
             return Response(ChatbotSerializer(chatbot).data, status=status.HTTP_201_CREATED)
         
-        logger.error(f"Chatbot creation failed: {serializer.errors}")
+        logger.error("Chatbot creation failed: %s", serializer.errors)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
 @api_view(['GET', 'PUT', 'DELETE'])
@@ -205,16 +269,17 @@ def chatbot_detail(request, chatbot_id):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     elif request.method == 'DELETE':
+        chatbot_id = chatbot.id
+        documents = list(chatbot.documents.values_list('sha256', 'path'))
         chatbot.delete()
+        VectorIndex(chatbot_id).drop()
+        for sha256, path in documents:
+            submit_document_task(discard_document, chatbot_id, sha256, path)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def create_thread(request):
-    print(f"Request user: {request.user}")
-
-    logger.info(f"Received data for thread creation: {request.data}")
-    
     chatbot_id = request.data.get('chatbot')
     if not chatbot_id:
         logger.error("No chatbot ID provided")
@@ -223,28 +288,68 @@ def create_thread(request):
     try:
         chatbot = Chatbot.objects.get(id=chatbot_id, owner=request.user)
     except Chatbot.DoesNotExist:
-        logger.error(f"Chatbot with id {chatbot_id} not found or doesn't belong to the user")
+        logger.error("Chatbot with id %s not found or doesn't belong to the user", chatbot_id)
         return Response({'error': 'Invalid chatbot ID'}, status=status.HTTP_400_BAD_REQUEST)
 
     serializer = ThreadSerializer(data={'chatbot': chatbot.id}, context={'request': request})
     if serializer.is_valid():
         thread = serializer.save(owner=request.user)
-        logger.info(f"Thread created successfully: {thread.id}")
+        logger.info("Thread created successfully: %s", thread.id)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     
-    logger.error(f"Thread creation failed. Errors: {serializer.errors}")
+    logger.error("Thread creation failed. Errors: %s", serializer.errors)
     return Response({
         'error': 'Invalid data',
         'details': serializer.errors
     }, status=status.HTTP_400_BAD_REQUEST)
     
+def _rate_limited(error, response_class=Response):
+    response = response_class({'error': 'Rate limit exceeded', 'scope': error.scope, 'limit': error.limit},
+                              status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+def _release_after(content, admission):
+    try:
+        yield from content
+    finally:
+        admission.release()
+
+def limit_chat_rate(view):
+    # Rejected requests are answered before the view runs, so they never touch the database.
+    # Streamed replies keep their slots until the last byte is sent, queued ones until their job finishes.
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        chatbot_id = request.data.get('chatbot_id')
+        if not chatbot_id:
+            return view(request, *args, **kwargs)
+        bind_chatbot(chatbot_id)
+        content = request.data.get('content')
+        try:
+            admission = rate_limiter.admit(
+                request.user, client_ip(request), chatbot_id, estimate_tokens(content if isinstance(content, str) else '')
+            )
+        except RateLimited as error:
+            return _rate_limited(error)
+        # A view that hands its work to a background job passes the admission on with it
+        request.rate_limit_admission = admission
+        try:
+            response = view(request, *args, **kwargs)
+        except BaseException:
+            admission.release()
+            raise
+        if response.streaming:
+            response.streaming_content = _release_after(response.streaming_content, admission)
+        else:
+            admission.release()
+        return response
+    return wrapper
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@limit_chat_rate
 def send_message(request):
     try:
-        # Log the incoming request data
-        logger.debug(f"Request data: {request.data}")
-
         # Extract necessary fields from the request data
         chatbot_id = request.data.get('chatbot_id')
         thread_id = request.data.get('thread_id')
@@ -258,40 +363,171 @@ def send_message(request):
         chatbot = get_object_or_404(Chatbot, id=chatbot_id)
         thread = get_object_or_404(Thread, id=thread_id)
 
-        # Serialize and save the user message
-        user_message_serializer = MessageSerializer(data={'thread': thread.id, 'role': 'user', 'content': content})
-        if user_message_serializer.is_valid():
-            user_message = user_message_serializer.save()
-        else:
-            logger.error(f"User message serializer errors: {user_message_serializer.errors}")
-            return Response(user_message_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        # In async mode the reply is generated by a background worker and fetched through /api/jobs/<id>/,
+        # so the user message is saved up front for the job to refer to
+        if request.data.get('async'):
+            user_message = Message.objects.create(thread=thread, role='user', content=content)
+            job = enqueue_generation(chatbot, thread, user_message, getattr(request, 'rate_limit_admission', None))
+            return Response({
+                'job_id': job.id,
+                'status': job.status,
+                'user_message': CompactMessageSerializer(user_message).data
+            }, status=status.HTTP_202_ACCEPTED)
 
-        # Generate the response from the chatbot
-        response = chatbot.generate_response(content, thread_id)
-
-        # Serialize and save the assistant message
-        assistant_message_serializer = MessageSerializer(data={'thread': thread.id, 'role': 'assistant', 'content': response})
-        if assistant_message_serializer.is_valid():
-            assistant_message = assistant_message_serializer.save()
-        else:
-            logger.error(f"Assistant message serializer errors: {assistant_message_serializer.errors}")
-            return Response(assistant_message_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        # Generate the response from the chatbot, then save both messages at once
+        turn = Turn(thread, content)
+        with turn.generating(), request_metrics.collect_usage() as usage:
+            response = chatbot.generate_response(content, thread_id)
+        user_message, assistant_message = turn.save(response, usage.as_metadata())
 
         # Return the user and assistant messages
         return Response({
-            'user_message': MessageSerializer(user_message).data,
-            'assistant_message': MessageSerializer(assistant_message).data
+            'user_message': CompactMessageSerializer(user_message).data,
+            'assistant_message': CompactMessageSerializer(assistant_message).data
         }, status=status.HTTP_200_OK)
+    except UpstreamError as e:
+        # Nothing was saved: a failed reply mustn't leave the user message, or an error text, in the history
+        return Response({'error': str(e)}, status=e.status)
     except Exception as e:
         logger.exception("An error occurred in send_message")
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
+# Upper bound for ?wait= on the async job endpoint, kept below typical proxy timeouts
+JOB_MAX_WAIT = 25
+
+def _job_wait(query_params):
+    """The ?wait= of a job request in seconds, capped at JOB_MAX_WAIT; raises ValueError if it isn't a number."""
+    wait = float(query_params.get('wait', 0))
+    if not math.isfinite(wait):
+        raise ValueError(wait)
+    return min(max(wait, 0), JOB_MAX_WAIT)
+
+def _job_data(job):
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'error': job.error,
+        'user_message': CompactMessageSerializer(job.user_message).data,
+        'assistant_message': CompactMessageSerializer(job.assistant_message).data if job.assistant_message else None
+    }
+
+def _can_see_job(user, job):
+    return user.id in (job.thread.owner_id, job.chatbot.owner_id) or user.is_staff
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_generation_job(request, job_id):
+    # Answers at once, as a long poll would hold a sync worker: clients long-poll /api/async/jobs/<id>/?wait= instead
+    job = get_object_or_404(
+        GenerationJob.objects.select_related('thread', 'chatbot', 'user_message', 'assistant_message'), id=job_id
+    )
+    if not _can_see_job(request.user, job):
+        return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
+    return Response(_job_data(job))
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@limit_chat_rate
+def send_message_stream(request):
+    chatbot_id = request.data.get('chatbot_id')
+    thread_id = request.data.get('thread_id')
+    content = request.data.get('content')
+
+    if not chatbot_id or not thread_id or not content:
+        return Response({'error': 'chatbot_id, thread_id, and content are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    chatbot = get_object_or_404(Chatbot, id=chatbot_id)
+    thread = get_object_or_404(Thread, id=thread_id)
+
+    turn = Turn(thread, content)
+
+    def event_stream():
+        chunks = []
+        usage = request_metrics.GenerationUsage()
+
+        def save_turn(metadata=None):
+            return turn.save(''.join(chunks), {**usage.as_metadata(), **(metadata or {})})
+
+        try:
+            with turn.generating(), request_metrics.collect_usage() as usage:
+                for chunk in chatbot.stream_response(content, thread_id):
+                    chunks.append(chunk)
+                    yield _sse_event('token', {'content': chunk})
+        except GeneratorExit:
+            # Client went away mid-stream; keep what was generated so the thread stays consistent
+            if chunks:
+                save_turn({'incomplete': True})
+            raise
+        except UpstreamError as e:
+            yield _sse_event('error', {'error': str(e), 'status': e.status})
+            return
+        except Exception as e:
+            logger.exception("An error occurred in send_message_stream")
+            yield _sse_event('error', {'error': str(e)})
+            return
+
+        user_message, assistant_message = save_turn()
+        yield _sse_event('done', {
+            'user_message': CompactMessageSerializer(user_message).data,
+            'assistant_message': CompactMessageSerializer(assistant_message).data
+        })
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_thread_messages(request, thread_id):
+    thread = get_object_or_404(Thread.objects.select_related('chatbot'), id=thread_id)
+    if not (request.user.id in (thread.owner_id, thread.chatbot.owner_id) or request.user.is_staff):
+        return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        limit = parse_page_size(request.query_params.get('limit'))
+        messages, next_cursor = keyset_page(
+            Message.objects.filter(thread=thread).only('id', 'role', 'content', 'created_at', 'metadata'),
+            cursor=request.query_params.get('cursor'),
+            limit=limit,
+            descending=True
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'results': [
+            {
+                'id': message.id,
+                'role': message.role,
+                'content': message.content,
+                'created_at': message.created_at,
+                'metadata': message.metadata,
+            }
+            for message in messages
+        ],
+        'next_cursor': next_cursor
+    })
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_chatbot_types(request):
     chatbot_types = ChatbotFactory.get_all_chatbot_types()
     return Response(chatbot_types)
 
+@require_http_methods(['GET'])
+def metrics(request):
+    token = settings.CHATBOT_METRICS['TOKEN']
+    if not token and not settings.DEBUG:
+        # Per-view traffic, token usage and upstream state aren't for anyone who finds the URL
+        return HttpResponse('Set CHATBOT_METRICS_TOKEN to serve metrics.', status=403, content_type='text/plain')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(request_metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def upload_document(request, chatbot_id):
@@ -301,17 +537,15 @@ def upload_document(request, chatbot_id):
         return Response({'error': 'No file part'}, status=status.HTTP_400_BAD_REQUEST)
     
     file = request.FILES['file']
-    file_path = save_uploaded_file(file)
+    staged_path = stage_upload(file)
     
-    if file_path:
-        if 'documents' not in chatbot.settings:
-            chatbot.settings['documents'] = []
-        chatbot.settings['documents'].append({
-            'name': file.name,
-            'path': file_path
-        })
-        chatbot.save()
-        return Response({'message': 'File uploaded successfully', 'file_path': file_path})
+    if staged_path:
+        # Storing, deduplicating and indexing happen in the background; poll the documents list for progress
+        document = enqueue_document(chatbot, file.name, staged_path, file.size)
+        return Response(
+            {'message': 'File accepted for processing', 'file_path': staged_path, 'document': document.to_dict()},
+            status=status.HTTP_202_ACCEPTED
+        )
     else:
         return Response({'error': 'File upload failed'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -319,12 +553,23 @@ def upload_document(request, chatbot_id):
 @permission_classes([IsAuthenticated])
 def delete_document(request, chatbot_id, document_name):
     chatbot = get_object_or_404(Chatbot, id=chatbot_id, owner=request.user)
+    document = chatbot.documents.filter(name=document_name).order_by('created_at').first()
+    if document:
+        document.delete()
+        submit_document_task(discard_document, chatbot.id, document.sha256, document.path)
+        return Response({'message': 'Document deleted successfully'})
+
+    # Documents uploaded before per-document rows are listed in the chatbot's settings
     documents = chatbot.settings.get('documents', [])
     document = next((doc for doc in documents if doc['name'] == document_name), None)
 
     if document:
-        if delete_file(document['path']):
+        # Documents uploaded before the blob store own their file outright
+        deleted = release_blob(document['sha256']) if 'sha256' in document else delete_file(document['path'])
+        if deleted:
             documents.remove(document)
+            if 'sha256' in document and not any(doc.get('sha256') == document['sha256'] for doc in documents):
+                remove_document(chatbot.id, document['sha256'])
             chatbot.settings['documents'] = documents
             chatbot.save()
             return Response({'message': 'Document deleted successfully'})
@@ -335,12 +580,16 @@ def delete_document(request, chatbot_id, document_name):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@replica_reads()
 def get_documents(request, chatbot_id):
     chatbot = get_object_or_404(Chatbot, id=chatbot_id, owner=request.user)
-    documents = chatbot.settings.get('documents', [])
+    documents = [dict(doc, status=Document.STATUS_READY) for doc in chatbot.settings.get('documents', [])]
+    documents += [document.to_dict() for document in chatbot.documents.order_by('created_at')]
 
     for doc in documents:
-        doc['url'] = get_file_url(doc['path'])
+        # Until processing finishes the path may still point at the staged upload
+        if doc['status'] == Document.STATUS_READY:
+            doc['url'] = get_file_url(doc['path'])
 
     return Response({'documents': documents})
     
@@ -362,4 +611,145 @@ def thread_detail(request, thread_id):
 
     elif request.method == 'DELETE':
         thread.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        return Response(status=status.HTTP_204_NO_CONTENT)
+# Async variants of the chat endpoints, served without pinning a worker thread when running under ASGI.
+# They are plain Django views, so authentication is done by hand with the same JWT backend DRF uses.
+
+async def _aauthenticate(request):
+    try:
+        result = await sync_to_async(CachedJWTAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    if result is None:
+        return None
+    user, _ = result
+    return user
+
+def _unauthorized():
+    return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+def async_api_view(http_method_names):
+    # Django 4.2's csrf_exempt/require_http_methods wrap views synchronously, so async views do it here.
+    # Views are token-authenticated, so CSRF protection does not apply, same as DRF's APIView.
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in http_method_names:
+                return HttpResponseNotAllowed(http_method_names)
+            return await view(request, *args, **kwargs)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+def _serialize_messages(user_message, assistant_message):
+    return {
+        'user_message': CompactMessageSerializer(user_message).data,
+        'assistant_message': CompactMessageSerializer(assistant_message).data
+    }
+
+@async_api_view(['POST'])
+async def async_send_message(request):
+    user = await _aauthenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+
+    chatbot_id = data.get('chatbot_id')
+    thread_id = data.get('thread_id')
+    content = data.get('content')
+
+    if not chatbot_id or not thread_id or not content:
+        return JsonResponse({'error': 'chatbot_id, thread_id, and content are required'}, status=status.HTTP_400_BAD_REQUEST)
+    bind_chatbot(chatbot_id)
+
+    try:
+        admission = await sync_to_async(rate_limiter.admit)(
+            user, client_ip(request), chatbot_id, estimate_tokens(content if isinstance(content, str) else '')
+        )
+    except RateLimited as error:
+        return _rate_limited(error, JsonResponse)
+
+    try:
+        try:
+            chatbot = await Chatbot.objects.aget(id=chatbot_id)
+            thread = await Thread.objects.aget(id=thread_id)
+        except (Chatbot.DoesNotExist, Thread.DoesNotExist, DjangoValidationError):
+            return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            turn = Turn(thread, content)
+            with turn.generating(), request_metrics.collect_usage() as usage:
+                response = await chatbot.agenerate_response(content, thread_id)
+            user_message, assistant_message = await turn.asave(response, usage.as_metadata())
+            # The compact serializer doesn't touch the database, so it can run on the event loop
+            return JsonResponse(_serialize_messages(user_message, assistant_message))
+        except UpstreamError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        except Exception as e:
+            logger.exception("An error occurred in async_send_message")
+            return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    finally:
+        await sync_to_async(admission.release)()
+
+@async_api_view(['POST'])
+async def async_create_thread(request):
+    user = await _aauthenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+
+    chatbot_id = data.get('chatbot')
+    if not chatbot_id:
+        return JsonResponse({'error': 'Chatbot ID is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        chatbot = await Chatbot.objects.aget(id=chatbot_id, owner=user)
+    except (Chatbot.DoesNotExist, DjangoValidationError):
+        logger.error("Chatbot with id %s not found or doesn't belong to the user", chatbot_id)
+        return JsonResponse({'error': 'Invalid chatbot ID'}, status=status.HTTP_400_BAD_REQUEST)
+
+    thread = await Thread.objects.acreate(chatbot=chatbot, owner=user)
+    return JsonResponse(ThreadSerializer(thread).data, status=status.HTTP_201_CREATED)
+
+@async_api_view(['GET'])
+async def async_get_chat_logs(request, chatbot_id):
+    user = await _aauthenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    try:
+        chatbot = await Chatbot.objects.aget(id=chatbot_id, owner=user)
+    except (Chatbot.DoesNotExist, DjangoValidationError):
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    with replica_reads():
+        logs = await sync_to_async(lambda: list(_iter_chat_logs(chatbot)))()
+    return JsonResponse(logs, safe=False)
+
+@async_api_view(['GET'])
+async def async_get_generation_job(request, job_id):
+    user = await _aauthenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    try:
+        job = await GenerationJob.objects.select_related('thread', 'chatbot').aget(id=job_id)
+    except GenerationJob.DoesNotExist:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    if not _can_see_job(user, job):
+        return JsonResponse({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        wait = _job_wait(request.GET)
+    except ValueError:
+        return JsonResponse({'error': 'wait must be a number of seconds'}, status=status.HTTP_400_BAD_REQUEST)
+    job = await await_job(job.id, wait)
+    return JsonResponse(_job_data(job))
@@ -0,0 +1,13 @@
+import os
+import sys
+from django.core.asgi import get_asgi_application
+from .static_files import StaticFilesApplication
+
+# Add the project directory to the Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mochi_bot_backend.settings')
+# Tells settings.py it is serving ASGI, before the settings are loaded
+os.environ['DJANGO_SERVER_INTERFACE'] = 'asgi'
+
+application = StaticFilesApplication(get_asgi_application())
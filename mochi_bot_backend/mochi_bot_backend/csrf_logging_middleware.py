@@ -11,11 +11,12 @@ class CsrfLoggingMiddleware(CsrfViewMiddleware):
     def process_view(self, request, callback, callback_args, callback_kwargs):
         response = super().process_view(request, callback, callback_args, callback_kwargs)
         if response is None:
-            csrf_token = get_token(request)
-            logger.debug(f'CSRF token: {csrf_token}')
+            # Makes sure the response sets the CSRF cookie; the token itself is a secret and isn't logged
+            get_token(request)
+            logger.debug('CSRF check passed for %s', request.path)
         return response
 
     def process_exception(self, request, exception):
         if hasattr(exception, 'csrf_token'):
-            logger.error(f'CSRF verification failed: {exception}')
+            logger.error('CSRF verification failed: %s', exception)
         return None
\ No newline at end of file
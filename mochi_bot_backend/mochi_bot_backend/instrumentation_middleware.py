@@ -0,0 +1,99 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from chatbot import metrics
+
+
+class InstrumentationMiddleware:
+    """
+    Records wall time, database queries and time, upstream LLM time and tokens, and response size per view.
+
+    Queries and LLM calls are attributed through metrics.current_request_metrics, which stays set while a
+    streamed response is being generated, so streaming views are measured until their last byte.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not settings.CHATBOT_METRICS['ENABLED']:
+            return self.get_response(request)
+
+        request_metrics = metrics.RequestMetrics()
+        start = time.perf_counter()
+        token = metrics.current_request_metrics.set(request_metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_request_metrics.reset(token)
+        return self.finish(request, response, request_metrics, start)
+
+    async def __acall__(self, request):
+        if not settings.CHATBOT_METRICS['ENABLED']:
+            return await self.get_response(request)
+
+        request_metrics = metrics.RequestMetrics()
+        start = time.perf_counter()
+        token = metrics.current_request_metrics.set(request_metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_request_metrics.reset(token)
+        return self.finish(request, response, request_metrics, start)
+
+    def finish(self, request, response, request_metrics, start):
+        if response.streaming and not response.is_async:
+            response.streaming_content = self.measure_stream(
+                request, response, response.streaming_content, request_metrics, start
+            )
+        else:
+            size = 0 if response.streaming else len(response.content)
+            self.record(request, response, request_metrics, start, size)
+        return response
+
+    def measure_stream(self, request, response, content, request_metrics, start):
+        size = 0
+        iterator = iter(content)
+        try:
+            while True:
+                token = metrics.current_request_metrics.set(request_metrics)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    metrics.current_request_metrics.reset(token)
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(iterator, 'close'):
+                # Closing runs the view's cleanup (e.g. saving a partial reply), which should count too
+                token = metrics.current_request_metrics.set(request_metrics)
+                try:
+                    iterator.close()
+                finally:
+                    metrics.current_request_metrics.reset(token)
+            self.record(request, response, request_metrics, start, size)
+
+    def record(self, request, response, request_metrics, start, size):
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        metrics.http_request_duration.observe(
+            time.perf_counter() - start, view=view, method=request.method, status=response.status_code
+        )
+        metrics.http_response_bytes.observe(size, view=view)
+        metrics.db_queries_per_request.observe(request_metrics.queries, view=view)
+        metrics.db_query_duration.observe(request_metrics.query_seconds, view=view)
+        if request_metrics.llm_calls:
+            metrics.request_llm_duration.observe(request_metrics.llm_seconds, view=view)
+            metrics.request_llm_tokens.inc(request_metrics.input_tokens, view=view, direction='input')
+            metrics.request_llm_tokens.inc(request_metrics.output_tokens, view=view, direction='output')
+        metrics.registry.flush()
@@ -0,0 +1,91 @@
+import logging
+import time
+import uuid
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .structured_logging import LogContext, bind_chatbot, current_log_context
+
+logger = logging.getLogger('mochi_bot_backend.requests')
+
+
+class RequestLoggingMiddleware:
+    """
+    Tags the log records of each request with its id (the X-Request-ID header, or a new one, echoed back),
+    its chatbot and its elapsed time, and logs one line per request once the response is done: for streamed
+    responses, after the last byte.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def start(self, request):
+        request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        return LogContext(request_id[:64], request)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        context = self.start(request)
+        token = current_log_context.set(context)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_log_context.reset(token)
+        return self.finish(request, response, context)
+
+    async def __acall__(self, request):
+        context = self.start(request)
+        token = current_log_context.set(context)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_log_context.reset(token)
+        return self.finish(request, response, context)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        bind_chatbot(view_kwargs.get('chatbot_id'))
+
+    def finish(self, request, response, context):
+        response['X-Request-ID'] = context.request_id
+        if response.streaming and not response.is_async:
+            response.streaming_content = self.log_stream(request, response, response.streaming_content, context)
+        else:
+            self.log(request, response, context)
+        return response
+
+    def log_stream(self, request, response, content, context):
+        # Streamed content is produced after the middleware returned, so the context is put back around each chunk
+        iterator = iter(content)
+        try:
+            while True:
+                token = current_log_context.set(context)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    current_log_context.reset(token)
+                yield chunk
+        finally:
+            if hasattr(iterator, 'close'):
+                token = current_log_context.set(context)
+                try:
+                    iterator.close()
+                finally:
+                    current_log_context.reset(token)
+            self.log(request, response, context)
+
+    def log(self, request, response, context):
+        token = current_log_context.set(context)
+        try:
+            logger.info(
+                "%s %s %s", request.method, request.path, response.status_code,
+                extra={'status': response.status_code, 'duration_ms': round((time.perf_counter() - context.started) * 1000, 1)},
+            )
+        finally:
+            current_log_context.reset(token)
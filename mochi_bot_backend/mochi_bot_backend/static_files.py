@@ -0,0 +1,31 @@
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
+from whitenoise import WhiteNoise
+
+# Names collectstatic's manifest storage gives files, which never change and can be cached for good
+HASHED_FILE = r'^.+\.[0-9a-f]{12}\..+$'
+
+
+def _not_found(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'text/plain')])
+    return [b'Not Found']
+
+
+class StaticFilesApplication:
+    """
+    The ASGI deployment's stand-in for WhiteNoiseMiddleware: serves STATIC_URL from STATIC_ROOT and passes
+    every other request to Django's async handler untouched. WhiteNoise itself is synchronous, so static
+    files are served on a thread, but API requests never are.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.static = WsgiToAsgi(WhiteNoise(
+            _not_found, root=settings.STATIC_ROOT, prefix=settings.STATIC_URL, autorefresh=settings.DEBUG,
+            max_age=0 if settings.DEBUG else 60, immutable_file_test=HASHED_FILE,
+        ))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(settings.STATIC_URL):
+            return await self.static(scope, receive, send)
+        return await self.application(scope, receive, send)
@@ -0,0 +1,51 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+_DONE = object()
+
+
+async def iterate_in_thread(content, close):
+    """
+    Iterate a sync iterator one chunk at a time on the request's thread, so each chunk is sent as soon as
+    it's made. Django 4.2 would otherwise read a sync iterator to the end before sending any of it.
+    """
+    iterator = iter(content)
+    finished = False
+    try:
+        while True:
+            chunk = await sync_to_async(next)(iterator, _DONE)
+            if chunk is _DONE:
+                finished = True
+                break
+            yield chunk
+    finally:
+        if not finished:
+            # The client went away: close the view's generator (which may save a partial reply) on the
+            # request's thread now, since Django 4.2 skips response.close() when sending fails
+            await sync_to_async(close)()
+
+
+class AsyncStreamingMiddleware:
+    """
+    Under ASGI, turns sync streamed responses (the SSE replies, the log export) into async ones. It comes
+    first in MIDDLEWARE so the other middleware keep wrapping plain sync iterators.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if response.streaming and not response.is_async:
+            response.streaming_content = iterate_in_thread(response.streaming_content, response.close)
+        return response
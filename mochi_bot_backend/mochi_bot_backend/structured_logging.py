@@ -0,0 +1,123 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from django.conf import settings
+
+# Attributes every LogRecord has; anything else on a record came from `extra=` and goes into the JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class LogContext:
+    """What log records emitted while serving a request are tagged with."""
+
+    def __init__(self, request_id, request=None):
+        self.request_id = request_id
+        self.request = request
+        self.chatbot_id = None
+        self.started = time.perf_counter()
+        self.sampled = None
+
+
+# The request being served in the current context, if any
+current_log_context: ContextVar = ContextVar('current_log_context', default=None)
+
+
+def bind_chatbot(chatbot_id):
+    """Tag the rest of the current request's log records with the chatbot it is about."""
+    context = current_log_context.get()
+    if context is not None and chatbot_id:
+        context.chatbot_id = str(chatbot_id)
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds request_id, chatbot_id and elapsed_ms (since the request started) to records made during a request."""
+
+    def filter(self, record):
+        context = current_log_context.get()
+        if context is not None:
+            record.request_id = context.request_id
+            if context.chatbot_id:
+                record.chatbot_id = context.chatbot_id
+            record.elapsed_ms = round((time.perf_counter() - context.started) * 1000, 1)
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """
+    Keeps the DEBUG records of a sample of requests: all of a sampled request's, none of the others'.
+
+    The rate is CHATBOT_LOGGING['DEBUG_SAMPLE_RATES'] for the request's view, or DEBUG_SAMPLE_RATE. Records
+    made outside requests, and records above DEBUG, always pass.
+    """
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        context = current_log_context.get()
+        if context is None:
+            return True
+        if context.sampled is None:
+            match = getattr(context.request, 'resolver_match', None)
+            rates = settings.CHATBOT_LOGGING['DEBUG_SAMPLE_RATES']
+            rate = rates.get(match.view_name, settings.CHATBOT_LOGGING['DEBUG_SAMPLE_RATE']) if match else (
+                settings.CHATBOT_LOGGING['DEBUG_SAMPLE_RATE']
+            )
+            context.sampled = random.random() < rate
+        return context.sampled
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the request context and any `extra=` fields as keys of their own."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class QueueingStreamHandler(QueueHandler):
+    """
+    Hands records to a background thread that formats and writes them, so request threads never block on
+    log I/O. The handler's formatter is applied on that thread; only the message itself is rendered before
+    the record is queued, since its arguments may change afterwards.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.StreamHandler(stream)
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
@@ -13,14 +13,23 @@ urlpatterns = [
     path('api/chatbot/', views.chatbot_list),
     path('api/chatbot/<str:chatbot_id>/', views.chatbot_detail),
     path('api/thread/', views.create_thread),
+    path('api/thread/<uuid:thread_id>/messages/', views.get_thread_messages),
     path('api/chat/', views.send_message),
+    path('api/chat/stream/', views.send_message_stream),
+    path('api/jobs/<uuid:job_id>/', views.get_generation_job),
     path('api/chatbot_types/', views.get_chatbot_types),
     path('api/chatbot/<str:chatbot_id>/upload_document/', views.upload_document),
     path('api/chatbot/<str:chatbot_id>/delete_document/<str:document_name>/', views.delete_document),
     path('api/chatbot/<str:chatbot_id>/documents/', views.get_documents),
     path('api/chatbot/<uuid:chatbot_id>/settings/', views.chatbot_settings),
     path('api/debug/', debug_view, name='debug_view'),
+    path('metrics', views.metrics),
     path('api/chatbot/<str:chatbot_id>/logs/', views.get_chat_logs),
+    path('api/chatbot/<str:chatbot_id>/logs/export/', views.export_chat_logs),
+    path('api/async/thread/', views.async_create_thread),
+    path('api/async/chat/', views.async_send_message),
+    path('api/async/chatbot/<str:chatbot_id>/logs/', views.async_get_chat_logs),
+    path('api/async/jobs/<uuid:job_id>/', views.async_get_generation_job),
     
 ]
 